@@ -36,19 +36,22 @@ ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
 SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 #==============================Imports=======================================
-import sys, ujson, cv2, numpy as np, base64
+import sys, time, argparse, ujson
 
 from twisted.python import log
-from twisted.internet import reactor
+from twisted.internet import reactor, threads
 from twisted.web.server import Site
 from twisted.web.wsgi import WSGIResource
 
 from autobahn.twisted.websocket import WebSocketClientFactory, \
          WebSocketServerFactory, WebSocketClientProtocol, \
          WebSocketServerProtocol, connectWS, listenWS
-from recognition import *
+from frame_protocol import unpackFrame, unpackLegacyFrame, packFrame
+from recorder import FrameRecorder
+from metrics import metrics
+from pipeline import FramePipeline
 
-from flask import Flask, render_template, request as flask_request, make_response
+from flask import Flask, render_template, request as flask_request, make_response, jsonify
 
 app = Flask(__name__)
 
@@ -61,6 +64,12 @@ DBHelper = DBHelper.DBHelper
 
 ip_address = "0.0.0.0"
 port_nums = [8090, 8091, 8073]
+default_camera = "camera1"
+record_path = None #file name to record incoming camera frames to, replay with replay_client.py, set with --record
+latency_budget = None #target milliseconds per frame, detection is made cheaper to meet it
+batch_size = 8 #most frames a worker runs face detection on at once
+batch_wait = 0.0 #seconds a worker waits for more of its cameras' frames before starting a batch
+cameras_per_worker = None #cameras packed onto a worker so they share batches, None spreads them over the workers
 compes_ip = "192.168.86.85"
 compes_ip = "ws://localhost:9000" #reassigning for using the test hub. 
 
@@ -110,60 +119,115 @@ class WebsiteServerProtocol(WebSocketServerProtocol):
         """
         Programmed by: David Williams and Jake Thomas
         Description: Handles the connections from clients that are requesting to connect the server.
+        Notes:
+                1. A viewer watches one camera at a time. It starts on the signed in user's
+                   camera and can switch by sending {"subscribe": "<camera_id>"}.
+                2. Adding "overlay": "client" to the subscribe message asks for the camera's
+                   original frames plus a JSON overlay message instead of frames annotated
+                   by the server.
         """
         def __init__(self):
                 WebSocketServerProtocol.__init__(self)
                 self.connected = False
+                self.cameraName = None
+                self.overlay = "server"
 
         def onConnect(self, request):
                 """
                 Programmed by: David Williams
                 Description: Prints the web socket request
                 """
-                self.cameraName = self.factory.bridge.camera
                 self.connected = True
-                
-                self.factory.connect("client1", self)
 
                 print("WebSocket connection request: {}".format(request.peer))
 
         def onOpen(self):
+                self.factory.subscribe(self, self.factory.bridge.camera or default_camera)
                 print("Connection to client opened!")
 
         def onMessage(self, data, isBinary):
-                data = ujson.loads(data.decode("UTF8"))
-                #self..clientName = data.decode("UTF8")
-                self.factory.connect(self.clientName, self)
+                """
+                Description: Switches the camera this viewer is subscribed to
+                """
+                try:
+                        data = ujson.loads(data.decode("UTF8"))
+                        self.overlay = "client" if data.get("overlay") == "client" else "server"
+                        self.factory.subscribe(self, data.get("subscribe") or self.cameraName)
+                except (ValueError, AttributeError):
+                        print("Unknown message from client: {}".format(data))
 
 
         def onClose(self, wasClean, code, reason):
                 self.connected = False
-                self.factory.disconnect("client1")
+                self.factory.unsubscribe(self)
                 print("Connection to client was closed!")
 
 class WebFactory(WebSocketServerFactory):
+        """
+        Description: Fans processed frames out to every viewer subscribed to a camera.
+        Notes:
+                1. Each frame is framed as a websocket message once per camera and the
+                   prepared message is sent to every subscriber, so extra viewers do not
+                   add encoding work.
+                2. Viewers drawing the overlay themselves get the camera's original frame,
+                   preceded by a text message with the overlay metadata as JSON.
+                3. Cameras nobody is watching are processed headless, recognition runs
+                   but nothing is drawn or encoded.
+        """
         protocol = WebsiteServerProtocol
         def __init__(self, url, bridge):
                 WebSocketServerFactory.__init__(self, url)
                 self.frame = None
-                self.connections = {}
+                self.connections = {} # camera id -> set of subscribed viewers
                 self.bridge = bridge
 
-        def connect(self, clientName, connection):
-                #if (clientName not in self.connections):
-                self.connections[clientName] = connection
+        def subscribe(self, connection, cameraName):
+                self.unsubscribe(connection)
+                connection.cameraName = cameraName
+                self.connections.setdefault(cameraName, set()).add(connection)
                 
-        def disconnect(self, clientName):
-                if ("client1" in self.connections):
-                        del self.connections["client1"]
-                else:
-                        print("Nothing to delete matching client name. ")
+        def unsubscribe(self, connection):
+                viewers = self.connections.get(connection.cameraName)
+                if viewers is not None:
+                        viewers.discard(connection)
+                        if not viewers:
+                                del self.connections[connection.cameraName]
+                connection.cameraName = None
+
+        def wantsAnnotation(self, cameraName):
+                """
+                Description: Returns True if a viewer of a camera wants the server to draw its overlay
+                """
+                return any(viewer.overlay == "server" for viewer in self.connections.get(cameraName, ()))
 
-        def post(self, clientName, message):
-                try: 
-                        self.connections["client1"].sendMessage(message)
-                except:
-                        pass
+        def post(self, cameraName, frame, original = None, overlay = None):
+                """
+                Description: Sends the annotated frame to viewers wanting server side overlays and
+                             the original frame with its overlay metadata to all others
+                """
+                viewers = self.connections.get(cameraName)
+                if not viewers:
+                        return
+                if frame is not None:
+                        self._broadcast(cameraName, frame, True, "server")
+                if original is not None:
+                        self._broadcast(cameraName, ujson.dumps(overlay).encode("UTF8"), False, "client")
+                        self._broadcast(cameraName, original, True, "client")
+
+        def notify(self, cameraName, message):
+                """
+                Description: Sends a text notification to every viewer of a camera
+                """
+                self._broadcast(cameraName, message.encode("UTF8"), False)
+
+        def _broadcast(self, cameraName, payload, isBinary, overlay = None):
+                viewers = [viewer for viewer in self.connections.get(cameraName, ())
+                           if overlay is None or viewer.overlay == overlay]
+                if not viewers:
+                        return
+                prepared = self.prepareMessage(payload, isBinary)
+                for viewer in viewers:
+                        viewer.sendPreparedMessage(prepared)
                 
 
 #==========================Camera Server=====================================
@@ -190,37 +254,30 @@ class CameraServerProtocol(WebSocketServerProtocol):
         def onMessage(self, data, isBinary):
                 """
                 Description: Decodes the image sent from the camera 
+                Notes:
+                        1. Binary messages use the format in frame_protocol, text messages
+                           are the legacy JSON format and are accepted during migration.
                 """
-                #STEP 1: Load in, convert, and decompress frame for use
-                frame = ujson.loads(data.decode("utf8"))
-                frame = np.asarray(frame, np.uint8)
-                frame = cv2.imdecode(frame, cv2.IMREAD_COLOR)
-                #post users client name here. 
-                
-                #frame = message
-                
-                if (self.factory.bridge.user is not None):
-                        frame, username, gesture = self.factory.rec.processFrame(frame, self.factory.bridge.user)
-                        if (gesture != '0'): #gesture is '0' by default
-                                db = DBHelper(True)
-                                gest_func = db.getGestureFunction(username, "gest_" + str(gesture))
-
-                                acu = db.getACUByUsername(username)
-                                tag = acu + ",," + str(gest_func)
-                                if gest_func != None:
-                                        self.factory.bridge.sendTag(tag)
-                        
-                if (self.factory.rec.is_registering == False and self.factory.rec.reg_complete == True):
-                        self.factory.bridge.web_factory.connections["client1"].sendMessage("registration".encode("UTF8"))
-                frame = cv2.UMat(frame)
-                frame = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 20])[1]
-                frame = base64.b64encode(frame)
-                
-                #send to web factory
-                self.factory.bridge.web_factory.post(self.factory.bridge.user, frame)
+                with metrics.timer(self.clientName, "on_message"):
+                        #STEP 1: Unpack the frame, decoding happens in the frame pipeline
+                        if isBinary:
+                                message = unpackFrame(data)
+                        else:
+                                message = unpackLegacyFrame(data, self.clientName)
+
+                        if (self.factory.recorder is not None):
+                                if not isBinary:
+                                        data = packFrame(self.clientName, 0, time.time(), message.payload)
+                                self.factory.recorder.write(data)
+
+                        #STEP 2: Queue the frame for processing off the reactor
+                        annotate = self.factory.bridge.web_factory.wantsAnnotation(self.clientName)
+                        self.factory.pipeline.submit(self.clientName, message.payload,
+                                                     self.factory.bridge.user, annotate)
 
         def onClose(self, wasClean, code, reason):
                 self.factory.disconnect(self.clientName)
+                self.factory.pipeline.removeCamera(self.clientName)
                 print("Connection to client was closed!")
 
 
@@ -231,7 +288,10 @@ class CameraFactory(WebSocketServerFactory):
                 self.frame = None
                 self.connections = {}
                 self.bridge = bridge
-                self.rec = Recognition()
+                self.pipeline = FramePipeline(self.frameProcessed, batch_size = batch_size,
+                                              batch_wait = batch_wait, latency_budget = latency_budget,
+                                              cameras_per_worker = cameras_per_worker)
+                self.recorder = FrameRecorder(record_path) if record_path else None
 
         def connect(self, clientName, connection):
                 if (clientName not in self.connections):
@@ -245,9 +305,41 @@ class CameraFactory(WebSocketServerFactory):
                 else:
                         print("Nothing to delete matching client name. ")
 
+        def frameProcessed(self, clientName, original, result, received):
+                """
+                Description: Receives a processed frame from the frame pipeline, sends any
+                             gesture tag to CoMPES and forwards the frame to the webpage.
+                """
+                frame, username, gesture, reg_complete, overlay = result
+                if (gesture != '0'): #gesture is '0' by default
+                        db = DBHelper(True)
+                        gest_func = db.getGestureFunction(username, "gest_" + str(gesture))
+
+                        acu = db.getACUByUsername(username)
+                        tag = acu + ",," + str(gest_func)
+                        if gest_func != None:
+                                self.bridge.sendTag(tag)
+                                metrics.observe(clientName, "tag_latency", (time.time() - received) * 1000)
+
+                if (reg_complete == True):
+                        self.bridge.web_factory.notify(clientName, "registration")
+
+                #send to web factory
+                self.bridge.web_factory.post(clientName, frame, original, overlay)
+
         def post(self, clientName, message):
                 self.connections[clientName].sendMessage(message.encode("UTF8"))
 
+        def metricsSnapshot(self):
+                """
+                Description: Collects the pipeline metrics of every camera, must run on the reactor
+                """
+                cameras = metrics.snapshot()
+                for camera, stats in self.pipeline.stats().items():
+                        cameras.setdefault(camera, {"rates": {}, "stages": {}}).update(stats)
+                models = {str(worker): timings for worker, timings in self.pipeline.model_timings.items()}
+                return {"idle_timeout": metrics.idle_timeout, "cameras": cameras, "models": models}
+
 
 
 #==========================CoMPES Client=====================================
@@ -305,6 +397,18 @@ def reg_complete():
         resp = make_response(render_template('active.html', user=comms.user))
         return resp
 
+@app.route("/metrics", methods = ["GET"])
+def get_metrics():
+        """
+        Description: Returns per camera fps, queue depth, frame counters (processed, dropped,
+                     failed) and stage timings as JSON.
+        Notes:
+                1. Timings are only collected while this route is being scraped, the first
+                   scrape after a pause returns counters only.
+                2. "models" has the milliseconds each worker took to load and warm up its models.
+        """
+        return jsonify(threads.blockingCallFromThread(reactor, comms.cam_factory.metricsSnapshot))
+
 @app.route("/connect", methods = ["POST"])
 def connect():
         #process users credentials here. 
@@ -393,7 +497,7 @@ def register():
                         
                         global comms
                         comms.registerUser(username, password, netID, hubID, acu_id, access_key)
-                        comms.cam_factory.rec.is_registering = True
+                        comms.cam_factory.pipeline.startRegistration(comms.camera)
                         resp = make_response(render_template('profile.html', user = username))
                         return resp
                 else: 
@@ -410,6 +514,14 @@ def main():
                 1.
                 2.
         """
+        parser = argparse.ArgumentParser(description="Run the FandRec server")
+        parser.add_argument("--record", metavar="PATH",
+                            help="file to record incoming camera frames to, replay with replay_client.py")
+        args = parser.parse_args()
+        global record_path
+        if args.record:
+                record_path = args.record
+
         log.startLogging(sys.stdout)
         #initRecognizer()
         global comms
@@ -419,6 +531,11 @@ def main():
         
         #STEP-5: Setup the reactor
         reactor.listenTCP(port_nums[0], Site(wsResourse))
+        reactor.addSystemEventTrigger('before', 'shutdown', comms.cam_factory.pipeline.shutdown)
+        #models are loaded by the workers once the servers are listening
+        reactor.callWhenRunning(comms.cam_factory.pipeline.warmUp)
+        if comms.cam_factory.recorder is not None:
+                reactor.addSystemEventTrigger('before', 'shutdown', comms.cam_factory.recorder.close)
 
         #STEP-6: run
         reactor.run()
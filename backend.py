@@ -0,0 +1,159 @@
+"""
+Project: FandRec
+Description: Selects where the full resolution image operations of recognition
+             and gesture run: on the CPU with ndarrays, or on an OpenCL device
+             through OpenCV's transparent API with UMats.
+Notes:
+    1. The backend is picked once per process, by the FANDREC_BACKEND environment
+       variable ("cpu", "opencl" or "auto", the default). "auto" times a short
+       micro-benchmark of the frame preprocessing with every available backend
+       and keeps the fastest.
+    2. A frame is uploaded once and stays in the backend's memory for the whole
+       of Recognition.processFrame. Operations that need host memory (dlib
+       trackers, contour analysis, pasting into the displayed frame) take their
+       input through toHost, which is a no-op for ndarrays.
+    3. Face detection and tracking run on the reduced resolution frame, which
+       always stays on the host.
+    4. BufferPool keeps the intermediate images of a camera between frames, so
+       that once the first frame is processed OpenCV writes into existing
+       memory instead of allocating new arrays.
+"""
+import os, time
+from collections import OrderedDict
+
+import cv2, numpy as np
+
+
+def toHost(image):
+    """:returns: image as an ndarray, downloading it if it is a UMat"""
+    if isinstance(image, cv2.UMat):
+        return image.get()
+    return image
+
+
+class Backend:
+    """Image operations that depend on where images are kept"""
+    def __init__(self, name, opencl):
+        """
+            :param name: "cpu" or "opencl"
+            :param opencl: run OpenCV operations on UMats through OpenCL
+        """
+        self.name = name
+        self.opencl = opencl
+
+        # milliseconds per frame measured by the startup benchmark, if it was run
+        self.benchmark_time = None
+
+    def upload(self, image):
+        """:returns: image in this backend's memory"""
+        if self.opencl and not isinstance(image, cv2.UMat):
+            return cv2.UMat(image)
+        return image
+
+    def empty(self, shape, dtype=np.uint8):
+        """:returns: an uninitialized image in this backend's memory"""
+        if self.opencl:
+            return cv2.UMat(np.empty(shape, dtype))
+        return np.empty(shape, dtype)
+
+    def roi(self, image, startX, startY, endX, endY):
+        """:returns: a region of image without copying it"""
+        if isinstance(image, cv2.UMat):
+            return cv2.UMat(image, [int(startY), int(endY)], [int(startX), int(endX)])
+        return image[startY:endY, startX:endX]
+
+    def __repr__(self):
+        return "Backend({})".format(self.name)
+
+
+class BufferPool:
+    """Named images that are allocated once and reused for every frame
+        A buffer is only reallocated when it is requested with another shape or
+        type, for instance when the size of a camera's frames changes.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.buffers = {}
+
+    def get(self, name, shape, dtype=np.uint8, host=False):
+        """
+            :param name: name of the buffer, unique within the pool
+            :param shape: numpy shape of the image
+            :param host: keep the buffer in host memory whatever the backend
+            :returns: the buffer, an ndarray or UMat whose contents are undefined
+        """
+        key = (tuple(shape), np.dtype(dtype), host)
+        entry = self.buffers.get(name)
+        if entry is None or entry[0] != key:
+            if host:
+                buffer = np.empty(shape, dtype)
+            else:
+                buffer = self.backend.empty(shape, dtype)
+            entry = self.buffers[name] = (key, buffer)
+        return entry[1]
+
+
+BACKENDS = OrderedDict([("cpu", Backend("cpu", False)),
+                        ("opencl", Backend("opencl", True))])
+
+# backend of this process, set by selectBackend
+_backend = None
+
+
+def available():
+    """:returns: names of the backends that can be used in this process"""
+    if cv2.ocl.haveOpenCL():
+        return list(BACKENDS)
+    return ["cpu"]
+
+
+def benchmarkBackend(backend, size=(480, 640), iterations=10):
+    """Times the full resolution preprocessing of processFrame with a backend,
+        including moving the frame to and from the device
+        :returns: median milliseconds per frame
+    """
+    cv2.ocl.setUseOpenCL(backend.opencl)
+    frame = np.random.default_rng(0).integers(0, 256, size + (3,), dtype=np.uint8)
+
+    def run():
+        image = cv2.flip(backend.upload(frame), 1)
+        gray = cv2.equalizeHist(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY))
+        gray = cv2.GaussianBlur(gray, (9, 9), 0)
+        return toHost(cv2.absdiff(gray, gray)), toHost(image)
+
+    # the first run compiles the OpenCL kernels
+    run()
+    times = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        run()
+        times.append((time.perf_counter() - start) * 1000)
+    return float(np.median(times))
+
+
+def selectBackend(mode="auto"):
+    """Sets the backend of this process
+        :param mode: "cpu", "opencl" or "auto" to pick the faster one
+        :returns: the selected Backend
+    """
+    global _backend
+    if mode == "auto":
+        candidates = [BACKENDS[name] for name in available()]
+        for backend in candidates:
+            backend.benchmark_time = benchmarkBackend(backend)
+        selected = min(candidates, key=lambda backend: backend.benchmark_time)
+    elif mode in available():
+        selected = BACKENDS[mode]
+    else:
+        raise ValueError("image backend {} is not available".format(mode))
+
+    cv2.ocl.setUseOpenCL(selected.opencl)
+    _backend = selected
+    return selected
+
+
+def getBackend():
+    """:returns: the backend of this process, selected on first use"""
+    if _backend is None:
+        selectBackend(os.environ.get("FANDREC_BACKEND", "auto"))
+    return _backend
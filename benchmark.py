@@ -0,0 +1,369 @@
+"""
+Project: FandRec
+Description: Benchmarks each stage of Recognition.processFrame, and the whole
+             pipeline, on synthetic or recorded frames.
+Notes:
+    1. Usage: python benchmark.py [--recording <file>] [--iterations N]
+                                  [--output results.json] [--baseline baseline.json]
+                                  [--save-baseline] [--tolerance 0.1]
+                                  [--face-input-size N]
+    2. Latency is reported as p50/p95/p99 in milliseconds together with the
+       throughput in frames per second, and written as JSON to --output.
+    3. With --baseline, every stage whose p50 is slower than the baseline by
+       more than --tolerance is reported as a regression and the exit status
+       is 1. --save-baseline writes the results to the baseline file instead.
+    4. Stages whose models or modules are not available are skipped. The face
+       detection, hand search and background stages call Recognition and
+       BackgroundModel, so they are skipped when recognition cannot be imported.
+       The face network runs at Recognition.face_input_size unless
+       --face-input-size picks another, such as one of the LatencyBudget sizes.
+    5. --check-allocations runs processFrame under tracemalloc and fails if any
+       steady state frame allocates more than --allocation-limit bytes at once,
+       by default the size of one grayscale frame.
+"""
+#==============================Imports=======================================
+import sys, os, time, argparse, platform, tracemalloc
+from collections import OrderedDict
+
+import cv2, ujson, numpy as np
+
+from frame_protocol import unpackFrame, decodeFrame
+from recorder import FrameReader
+from backend import getBackend
+
+#==============================Frames========================================
+
+def syntheticFrames(count, size=(480, 640), seed=0):
+    """Generates deterministic test frames: a smooth background with a few shapes and noise
+        :returns: a list of 8-bit BGR frames
+    """
+    rng = np.random.default_rng(seed)
+    h, w = size
+    yy, xx = np.mgrid[0:h, 0:w]
+    frames = []
+    for i in range(count):
+        frame = np.empty((h, w, 3), np.uint8)
+        frame[:,:,0] = (xx * 255 // w + i) % 256
+        frame[:,:,1] = (yy * 255 // h) % 256
+        frame[:,:,2] = 128
+        cv2.circle(frame, (w//2 + i % 20, h//3), h//8, (180, 200, 230), -1)
+        cv2.rectangle(frame, (w//5, h//2), (w//5 + w//10, h//2 + h//4), (150, 170, 200), -1)
+        noise = rng.integers(0, 16, (h, w, 3), dtype=np.uint8)
+        frames.append(cv2.add(frame, noise))
+    return frames
+
+def recordedFrames(path, count):
+    """Decodes up to count frames from a recording made with recorder.FrameRecorder
+        :returns: a list of 8-bit BGR frames
+    """
+    frames = []
+    with FrameReader(path) as reader:
+        # the views into the map must be gone before the reader closes it
+        messages = iter(reader)
+        for timestamp, message in messages:
+            frame = unpackFrame(message)
+            frames.append(decodeFrame(frame.payload))
+            del frame
+            message.release()
+            if len(frames) == count:
+                break
+        messages.close()
+    return frames
+
+def handMask(size=(160, 120)):
+    """Draws a binary mask of an open hand for the gesture recognizer"""
+    h, w = size
+    mask = np.zeros((h, w), np.uint8)
+    cv2.circle(mask, (w//2, h*2//3), w//4, 255, -1)
+    for i in range(5):
+        x = w//2 + (i - 2) * w//9
+        cv2.rectangle(mask, (x - 4, h//8), (x + 4, h*2//3), 255, -1)
+    return mask
+
+#==============================Stages========================================
+
+class Stages:
+    """Benchmark stages
+        Every method named bench<Stage> prepares its inputs and returns a function
+        running the stage once on frame i, or raises SkipStage.
+    """
+    def __init__(self, frames, face_input_size=None):
+        self.frames = frames
+        self.face_input_size = face_input_size
+        self.h, self.w = frames[0].shape[:2]
+        self.flipped = [cv2.flip(frame, 1) for frame in frames]
+        self.gray = [cv2.equalizeHist(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+                     for frame in self.flipped]
+
+    def stages(self):
+        return [(name[5].lower() + name[6:], getattr(self, name))
+                for name in Stages.__dict__ if name.startswith("bench")]
+
+    def recognition(self):
+        """Returns a Recognition set up for frames of the benchmark's size, or raises SkipStage"""
+        try:
+            from recognition import Recognition
+        except Exception as e:
+            raise SkipStage("recognition could not be imported: {}".format(e))
+        rec = Recognition()
+        rec.frame_dimensions = (self.h, self.w)
+        if self.face_input_size is not None:
+            rec.face_input_size = self.face_input_size
+        return rec
+
+    def facenet(self, rec):
+        """Loads the face network through the model registry, or raises SkipStage"""
+        if not os.path.isfile(rec.path_facemodel):
+            raise SkipStage(rec.path_facemodel + " not found")
+        return rec.facenet
+
+    def benchFlip(self):
+        return lambda i: cv2.flip(self.frames[i], 1)
+
+    def benchCvtColor(self):
+        return lambda i: cv2.cvtColor(self.flipped[i], cv2.COLOR_BGR2GRAY)
+
+    def benchEqualizeHist(self):
+        gray = [cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) for frame in self.flipped]
+        return lambda i: cv2.equalizeHist(gray[i])
+
+    def benchFacenet(self):
+        rec = self.recognition()
+        net = self.facenet(rec)
+        size = (rec.face_input_size, rec.face_input_size)
+        def run(i):
+            net.setInput(rec._faceBlob(self.flipped[i], size))
+            return net.forward()
+        return run
+
+    def benchFacenetBatch(self, batch=4):
+        # one network run for the frames of batch cameras sharing a worker,
+        # compare with batch times the facenet stage
+        rec = self.recognition()
+        self.facenet(rec)
+        count = len(self.flipped)
+        def run(i):
+            images = [self.flipped[(i + j) % count] for j in range(batch)]
+            return rec.detectFaces(images, rec.face_input_size)
+        return run
+
+    def benchLbphPredict(self, users=10, samples=100):
+        if not hasattr(cv2, "face"):
+            raise SkipStage("opencv-contrib is not installed")
+        rng = np.random.default_rng(1)
+        recognizer = cv2.face.LBPHFaceRecognizer_create()
+        images = [rng.integers(0, 256, (100, 100), dtype=np.uint8) for i in range(users * samples)]
+        recognizer.train(images, np.repeat(np.arange(users), samples))
+        y, x = self.h//4, self.w*2//5
+        faces = [cv2.resize(gray[y:y + self.h//4, x:x + self.w//5], (100, 100)) for gray in self.gray]
+        return lambda i: recognizer.predict(faces[i])
+
+    def benchEmbeddingPredict(self, users=2000, samples=3):
+        from face_index import EmbeddingRecognizer
+        rng = np.random.default_rng(1)
+        recognizer = EmbeddingRecognizer()
+        images = [rng.integers(0, 256, (100, 100), dtype=np.uint8) for i in range(users * samples)]
+        recognizer.train(images, np.repeat(np.arange(users), samples))
+        y, x = self.h//4, self.w*2//5
+        faces = [cv2.resize(gray[y:y + self.h//4, x:x + self.w//5], (100, 100)) for gray in self.gray]
+        return lambda i: recognizer.predict(faces[i])
+
+    def benchHaarDetect(self):
+        rec = self.recognition()
+        if rec.hand_classifier.empty():
+            raise SkipStage(rec.path_handmodel + " could not be loaded")
+        face = (self.w*2//5, self.h//4, self.w*3//5, self.h//2)
+        gray = [rec.backend.upload(image) for image in self.gray]
+        return lambda i: rec._findHands(gray[i], face)
+
+    def benchTrackerUpdate(self):
+        try:
+            import dlib
+        except ImportError:
+            raise SkipStage("dlib is not installed")
+        tracker = dlib.correlation_tracker()
+        tracker.start_track(self.flipped[0], dlib.rectangle(self.w//5, self.h//2,
+                                                            self.w//5 + self.w//6, self.h//2 + self.h//3))
+        return lambda i: tracker.update(self.flipped[i])
+
+    def benchBackgroundDiff(self):
+        rec = self.recognition()
+        gray = [rec.backend.upload(image) for image in self.gray]
+        model = rec.bg_model
+        while not model.calibrated:
+            model.runAverage(gray[model.num_frames % len(gray)])
+        # the hand region tracked while a gesture is recognized
+        x, y, w, h = self.w//5, self.h//3, self.w//4, self.h//2
+        def run(i):
+            foreground = model.foreground(gray[i], x, y, x + w, y + h)
+            model.adapt(gray[i], (x, y, w, h))
+            return foreground
+        return run
+
+    def benchGestureRecognize(self):
+        from gesture import HandGestureRecognition
+        recognizer = HandGestureRecognition()
+        mask = handMask()
+        return lambda i: recognizer.recognize(mask)
+
+    def benchProcessFrame(self):
+        rec = self.recognition()
+        return lambda i: rec.processFrame(self.frames[i], "benchmark")
+
+class SkipStage(Exception):
+    pass
+
+#==============================Measurement===================================
+
+def measure(run, count, iterations, warmup=5):
+    """Runs a stage repeatedly over the frames
+        :returns: dict of latency percentiles in ms and throughput in frames per second
+    """
+    for i in range(warmup):
+        run(i % count)
+    times = np.empty(iterations)
+    for i in range(iterations):
+        start = time.perf_counter()
+        run(i % count)
+        times[i] = time.perf_counter() - start
+    times *= 1000
+    return OrderedDict([("p50", float(np.percentile(times, 50))),
+                        ("p95", float(np.percentile(times, 95))),
+                        ("p99", float(np.percentile(times, 99))),
+                        ("mean", float(times.mean())),
+                        ("fps", float(1000 / times.mean()))])
+
+def checkAllocations(frames, iterations, warmup=10):
+    """Measures the memory allocated by steady state processFrame calls
+        Buffers are allocated on the first frames, so only the calls after warmup count.
+        :returns: list with the peak number of bytes allocated during each call
+    """
+    try:
+        from recognition import Recognition
+    except Exception as e:
+        raise SkipStage("recognition could not be imported: {}".format(e))
+    rec = Recognition()
+    for i in range(warmup):
+        rec.processFrame(frames[i % len(frames)], "benchmark")
+
+    peaks = []
+    tracemalloc.start()
+    try:
+        for i in range(iterations):
+            # clearing the traces also resets the peak
+            tracemalloc.clear_traces()
+            rec.processFrame(frames[i % len(frames)], "benchmark")
+            peaks.append(tracemalloc.get_traced_memory()[1])
+    finally:
+        tracemalloc.stop()
+    return peaks
+
+def compare(results, baseline, tolerance):
+    """Compares p50 latencies against a baseline
+        :returns: list of (stage, baseline_p50, p50) for every regressed stage
+    """
+    regressions = []
+    for name, stats in results["stages"].items():
+        base = baseline["stages"].get(name)
+        if base is not None and stats["p50"] > base["p50"] * (1 + tolerance):
+            regressions.append((name, base["p50"], stats["p50"]))
+    return regressions
+
+def printResults(results, baseline=None):
+    print("{:<20}{:>10}{:>10}{:>10}{:>10}{:>10}".format("stage", "p50 ms", "p95 ms", "p99 ms",
+                                                        "fps", "vs base"))
+    for name, stats in results["stages"].items():
+        change = ""
+        if baseline is not None and name in baseline["stages"]:
+            change = "{:+.1f}%".format((stats["p50"] / baseline["stages"][name]["p50"] - 1) * 100)
+        print("{:<20}{:>10.3f}{:>10.3f}{:>10.3f}{:>10.1f}{:>10}".format(
+            name, stats["p50"], stats["p95"], stats["p99"], stats["fps"], change))
+    for name, reason in results["skipped"].items():
+        print("{:<20}skipped: {}".format(name, reason))
+
+#==============================Main==========================================
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the stages of Recognition.processFrame")
+    parser.add_argument("--recording", help="frame recording to use instead of synthetic frames")
+    parser.add_argument("--frames", type=int, default=30, help="number of distinct frames")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--stages", help="comma separated list of stages to run")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", default="benchmark_baseline.json")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="allowed p50 slowdown against the baseline, 0.1 = 10%%")
+    parser.add_argument("--check-allocations", action="store_true",
+                        help="check that processFrame does not allocate frame sized arrays")
+    parser.add_argument("--allocation-limit", type=int,
+                        help="bytes a frame may allocate, defaults to one grayscale frame")
+    parser.add_argument("--face-input-size", type=int,
+                        help="side of the face network input, defaults to Recognition.face_input_size")
+    args = parser.parse_args()
+
+    if args.recording:
+        frames = recordedFrames(args.recording, args.frames)
+    else:
+        frames = syntheticFrames(args.frames)
+    if not frames:
+        sys.exit("no frames to benchmark")
+
+    if args.check_allocations:
+        limit = args.allocation_limit or frames[0].shape[0] * frames[0].shape[1]
+        try:
+            peaks = checkAllocations(frames, args.iterations)
+        except SkipStage as e:
+            sys.exit("allocation check skipped: {}".format(e))
+        over = [peak for peak in peaks if peak > limit]
+        print("processFrame allocations: max {} bytes, {} of {} frames over the {} byte limit".format(
+            max(peaks), len(over), len(peaks), limit))
+        if over:
+            sys.exit(1)
+        return
+
+    selected = args.stages.split(",") if args.stages else None
+    results = OrderedDict([("time", time.time()),
+                           ("source", args.recording or "synthetic"),
+                           ("frames", len(frames)),
+                           ("opencv", cv2.__version__),
+                           ("backend", getBackend().name),
+                           ("face_input_size", args.face_input_size),
+                           ("machine", platform.platform()),
+                           ("stages", OrderedDict()),
+                           ("skipped", OrderedDict())])
+
+    for name, prepare in Stages(frames, args.face_input_size).stages():
+        if selected is not None and name not in selected:
+            continue
+        try:
+            run = prepare()
+        except SkipStage as e:
+            results["skipped"][name] = str(e)
+            continue
+        results["stages"][name] = measure(run, len(frames), args.iterations)
+
+    with open(args.output, "w") as f:
+        f.write(ujson.dumps(results, indent=2))
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            f.write(ujson.dumps(results, indent=2))
+        printResults(results)
+        return
+
+    baseline = None
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            baseline = ujson.loads(f.read())
+    printResults(results, baseline)
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        for name, before, after in regressions:
+            print("REGRESSION {}: p50 {:.3f} ms -> {:.3f} ms".format(name, before, after))
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
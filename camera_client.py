@@ -31,7 +31,7 @@ ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
 SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 #==============================Imports=======================================
-import sys, ujson, cv2, imutils
+import sys, time, argparse, cv2, imutils
 import numpy as np
 
 from twisted.python import log
@@ -42,6 +42,8 @@ from autobahn.twisted.websocket import WebSocketClientFactory, \
     WebSocketClientProtocol, connectWS
 from twisted.internet import reactor
 from imutils.video import WebcamVideoStream
+from frame_protocol import packFrame
+from recorder import FrameRecorder
 #=======================Application Interface===========================
 class CameraClientProtocol(WebSocketClientProtocol):
     """
@@ -52,6 +54,7 @@ class CameraClientProtocol(WebSocketClientProtocol):
 
     def __init__(self):
         self.fps = 10
+        self.sequence = 0
 
     def onOpen(self):
         self.sendFrames()
@@ -59,18 +62,22 @@ class CameraClientProtocol(WebSocketClientProtocol):
     def sendFrames(self):
         """
         Description: Gets a frame from the camera then
-        encodes it as a json then sends it.
+        packs it as a binary frame message then sends it.
         """
 	# Grab frame
         frame = cv2.UMat(self.factory.camera.read())
+        timestamp = time.time()
         frame = cv2.resize(frame, (640,480))
 
 	# Compress and Package frame
-        out = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 70])[1].tolist()
-        out = ujson.dumps(out)
+        out = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 70])[1]
+        out = packFrame(self.factory.camera_id, self.sequence, timestamp, out)
+        self.sequence += 1
+        if self.factory.recorder is not None:
+            self.factory.recorder.write(out, timestamp)
 
 	# Send frame
-        self.sendMessage(out.encode("utf8"))
+        self.sendMessage(out, isBinary=True)
         reactor.callLater(1/self.fps, self.sendFrames)
 
 
@@ -78,8 +85,10 @@ class CameraClientFactory(WebSocketClientFactory):
     """
     Description: Starts the video capture from the local kinect or camera.
     """
-    def __init__(self, addr, cam_port):
-        WebSocketClientFactory.__init__(self, addr, headers={'camera_id': 'camera1'})
+    def __init__(self, addr, cam_port, camera_id='camera1', record_path=None):
+        WebSocketClientFactory.__init__(self, addr, headers={'camera_id': camera_id})
+        self.camera_id = camera_id
+        self.recorder = FrameRecorder(record_path) if record_path else None
         print("Starting Camera")
         self.camera = WebcamVideoStream(src=0).start()
 
@@ -90,14 +99,22 @@ def main():
     Description: Starts CameraClientProtocol defined above which sends
     the frames from the camera to the server
     """
+    parser = argparse.ArgumentParser(description="Send camera frames to the camera server")
+    parser.add_argument("--record", metavar="PATH",
+                        help="file to record sent frames to, replay with replay_client.py")
+    args = parser.parse_args()
+
     #STEP 1: Setup the factory
     log.startLogging(sys.stdout)
     ip_address = "127.0.0.1"
     port_num = 8091
 
-    factory = CameraClientFactory("ws://" + ip_address + ":" + str(port_num), 0)
+    factory = CameraClientFactory("ws://" + ip_address + ":" + str(port_num), 0,
+                                  record_path=args.record)
     factory.protocol = CameraClientProtocol
     reactor.connectTCP(ip_address, port_num, factory)
+    if factory.recorder is not None:
+        reactor.addSystemEventTrigger('before', 'shutdown', factory.recorder.close)
 
     #STEP 2: Start the reactor
     reactor.run()
@@ -163,6 +163,19 @@ class DBHelper:
 			return "NoUserExists"
 		if not keepConnOpen: self.disconnect()
 		
+	def getUserMap(self):
+		"""
+			
+			Output: Dictionary {Integer: String, ...}
+			Description: Returns every user ID mapped to its username. 
+			Usage: DBHelper.getUserMap()
+		
+		"""
+		curr.execute("SELECT ID, Username FROM Users")
+		users = dict(curr.fetchall())
+		if not keepConnOpen: self.disconnect()
+		return users
+		
 	def getIDByUsername(self, username):
 		"""
 			
@@ -0,0 +1,173 @@
+"""
+Project: FandRec
+Description: Face recognizer that keeps one compact feature vector per user in a
+             contiguous matrix, so identifying a face is a single matrix-vector
+             product however many users are registered.
+Notes:
+    1. Faces are described by uniform local binary pattern histograms over a
+       grid of cells, the same texture features LBPH uses. LBPH keeps every
+       sample's histogram and compares a face against all of them. Here the
+       samples of a user are summed into one vector.
+    2. Histograms are square rooted and L2 normalized, and the sum of a user's
+       sample features is L2 normalized again, so the dot product of a face with a user is
+       their cosine similarity. The distance a prediction reports is
+       1 - similarity, between 0 and 1, and lower is better as with LBPH.
+    3. EmbeddingRecognizer has the train/update/predict/read/write methods of
+       the cv2.face recognizers, so Recognition can use either.
+"""
+import numpy as np
+
+# offsets of the 8 neighbours of a pixel, in bit order
+NEIGHBOURS = [(-1, -1), (-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1)]
+
+
+def _uniformPatterns():
+    """:returns: lookup table mapping each 8 bit pattern to one of 58 uniform
+                    pattern bins, or bin 58 for the non-uniform patterns
+    """
+    table = np.full(256, 58, np.uint8)
+    uniform = 0
+    for code in range(256):
+        bits = [(code >> i) & 1 for i in range(8)]
+        transitions = sum(bits[i] != bits[(i + 1) % 8] for i in range(8))
+        if transitions <= 2:
+            table[code] = uniform
+            uniform += 1
+    return table
+
+UNIFORM = _uniformPatterns()
+BINS = 59
+
+
+def lbpFeatures(face, grid=(4, 4)):
+    """Describes a face by the uniform LBP histograms of a grid of cells
+        :param face: 8-bit grayscale face image, normally 100x100
+        :param grid: (rows, columns) of cells
+        :returns: float32 vector of rows * columns * 59 values with unit length
+    """
+    face = np.asarray(face)
+    h, w = face.shape
+    center = face[1:h-1, 1:w-1]
+    codes = np.zeros(center.shape, np.uint8)
+    for bit, (dy, dx) in enumerate(NEIGHBOURS):
+        codes |= (face[1+dy:h-1+dy, 1+dx:w-1+dx] >= center).astype(np.uint8) << bit
+
+    # index of the cell every pixel falls in, combined with its pattern bin
+    rows, cols = grid
+    cell_y = np.arange(h - 2) * rows // (h - 2)
+    cell_x = np.arange(w - 2) * cols // (w - 2)
+    cells = cell_y[:, None] * cols + cell_x[None, :]
+    histogram = np.bincount((cells * BINS + UNIFORM[codes]).ravel(),
+                            minlength=rows * cols * BINS).astype(np.float32)
+    return _normalize(np.sqrt(histogram))
+
+
+def _normalize(vectors):
+    """L2 normalizes vectors along their last axis"""
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class EmbeddingRecognizer:
+    """Nearest neighbour face recognizer over one feature vector per user
+        Each user's vector is the sum of the features of their samples, so users
+        can be updated with new samples without keeping the old ones.
+    """
+    def __init__(self, grid=(4, 4)):
+        """
+            :param grid: (rows, columns) of the LBP cells
+        """
+        self.grid = tuple(grid)
+        dimensions = grid[0] * grid[1] * BINS
+        self.labels = np.empty(0, np.int32)
+        self.counts = np.empty(0, np.int32)
+        # sum of the sample features of each user, and the normalized vectors searched
+        self.sums = np.empty((0, dimensions), np.float32)
+        self.matrix = np.empty((0, dimensions), np.float32)
+
+    def train(self, images, labels):
+        """Replaces every user with the given samples
+            :param images: 8-bit grayscale face images
+            :param labels: user id of each image
+        """
+        self.__init__(self.grid)
+        self.update(images, labels)
+
+    def update(self, images, labels):
+        """Adds samples, creating users that do not exist yet
+            :param images: 8-bit grayscale face images
+            :param labels: user id of each image
+        """
+        features = np.stack([lbpFeatures(image, self.grid) for image in images])
+        labels = np.asarray(labels, np.int32).ravel()
+        users = np.unique(labels)
+        self.updateSums(users, [features[labels == label].sum(axis=0) for label in users],
+                        [np.count_nonzero(labels == label) for label in users])
+
+    def updateSums(self, labels, sums, counts):
+        """Adds already summed sample features, as saved in a model store
+            :param labels: user id of each sum
+            :param sums: sum of the lbpFeatures of each user's new samples
+            :param counts: number of samples in each sum
+        """
+        rows = {int(label): i for i, label in enumerate(self.labels)}
+        existing = len(self.labels)
+        new_labels, new_sums, new_counts = [], [], []
+        for label, total, count in zip(labels, sums, counts):
+            total = np.reshape(total, -1)
+            row = rows.get(int(label))
+            if row is None:
+                rows[int(label)] = existing + len(new_labels)
+                new_labels.append(label)
+                new_sums.append(total.astype(np.float32))
+                new_counts.append(count)
+            elif row < existing:
+                self.sums[row] += total
+                self.counts[row] += count
+            else:
+                new_sums[row - existing] += total
+                new_counts[row - existing] += count
+        if new_labels:
+            self.labels = np.concatenate((self.labels, np.array(new_labels, np.int32)))
+            self.counts = np.concatenate((self.counts, np.array(new_counts, np.int32)))
+            self.sums = np.concatenate((self.sums, np.stack(new_sums)))
+        self.matrix = np.ascontiguousarray(_normalize(self.sums), np.float32)
+
+    def search(self, image, k=1):
+        """Finds the users whose vectors are closest to a face
+            :param image: 8-bit grayscale face image
+            :param k: number of users to return
+            :returns: (labels, distances) of at most k users, closest first
+        """
+        if not len(self.labels):
+            return (np.empty(0, np.int32), np.empty(0, np.float32))
+        similarities = self.matrix @ lbpFeatures(image, self.grid)
+        k = min(k, len(similarities))
+        if k < len(similarities):
+            top = np.argpartition(-similarities, k - 1)[:k]
+        else:
+            top = np.arange(k)
+        top = top[np.argsort(-similarities[top])]
+        return (self.labels[top], 1 - similarities[top])
+
+    def predict(self, image):
+        """:returns: (label, distance) of the closest user, (-1, inf) if there are no users"""
+        labels, distances = self.search(image)
+        if not len(labels):
+            return (-1, float("inf"))
+        return (int(labels[0]), float(distances[0]))
+
+    def write(self, path):
+        """Saves the user vectors to path"""
+        with open(path, "wb") as f:
+            np.savez(f, grid=np.array(self.grid), labels=self.labels,
+                     counts=self.counts, sums=self.sums)
+
+    def read(self, path):
+        """Loads user vectors saved with write"""
+        with np.load(path) as data:
+            self.grid = tuple(int(n) for n in data["grid"])
+            self.labels = data["labels"]
+            self.counts = data["counts"]
+            self.sums = data["sums"]
+        self.matrix = np.ascontiguousarray(_normalize(self.sums), np.float32)
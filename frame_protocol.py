@@ -0,0 +1,164 @@
+"""
+Project: FandRec
+Description: Binary wire format for frames sent from camera_client to the
+             camera server.
+Notes:
+    1. Every message is a fixed 32 byte header followed by the encoded image
+       bytes, sent as a binary websocket message.
+    2. The header is laid out in network byte order as
+           magic      2 bytes  b"FR"
+           version    1 byte
+           codec      1 byte
+           sequence   4 bytes  unsigned, wraps at 2**32
+           timestamp  8 bytes  capture time, seconds since the epoch
+           camera id 16 bytes  utf-8, NUL padded
+    3. Text messages are assumed to be the legacy format (a JSON list of the
+       JPEG bytes) and are still accepted while clients are migrated.
+    4. LazyFrame decodes a payload only when it is needed, and can decode it at
+       a reduced resolution for stages that do not need every pixel.
+"""
+import struct
+from collections import namedtuple
+
+import cv2, ujson, numpy as np
+
+MAGIC = b"FR"
+VERSION = 1
+
+CODEC_JPEG = 1
+
+# cv2.imread flags for decoding at 1/n of the full resolution
+REDUCED_FLAGS = {1: cv2.IMREAD_COLOR,
+                 2: cv2.IMREAD_REDUCED_COLOR_2,
+                 4: cv2.IMREAD_REDUCED_COLOR_4,
+                 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+HEADER = struct.Struct("!2sBBId16s")
+HEADER_SIZE = HEADER.size
+
+Frame = namedtuple("Frame", ["camera_id", "sequence", "timestamp", "codec", "payload"])
+
+
+def packFrame(camera_id, sequence, timestamp, payload, codec=CODEC_JPEG):
+    """Builds a binary frame message.
+        :param camera_id: name of the sending camera, at most 16 bytes of utf-8
+        :param sequence: frame counter of the sending camera
+        :param timestamp: capture time in seconds since the epoch
+        :param payload: encoded image, any object supporting the buffer protocol
+        :param codec: codec id of the payload
+        :returns: the message as bytes
+    """
+    camera_id = camera_id.encode("utf8")
+    if len(camera_id) > 16:
+        raise ValueError("camera id is longer than 16 bytes")
+    header = HEADER.pack(MAGIC, VERSION, codec, sequence & 0xFFFFFFFF, timestamp, camera_id)
+    return header + memoryview(payload).cast("B")
+
+
+def unpackFrame(data):
+    """Parses a binary frame message without copying the payload.
+        :param data: bytes of a message created with packFrame
+        :returns: a Frame whose payload is a memoryview into data
+    """
+    if len(data) < HEADER_SIZE:
+        raise ValueError("frame message is shorter than its header")
+    magic, version, codec, sequence, timestamp, camera_id = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("frame message has an invalid magic number")
+    if version != VERSION:
+        raise ValueError("unsupported frame message version: {}".format(version))
+    camera_id = camera_id.rstrip(b"\0").decode("utf8")
+    return Frame(camera_id, sequence, timestamp, codec, memoryview(data)[HEADER_SIZE:])
+
+
+def unpackLegacyFrame(data, camera_id=None):
+    """Parses a legacy text frame message (a JSON list of JPEG bytes).
+        :param data: utf-8 bytes of the message
+        :param camera_id: camera name taken from the connection headers
+        :returns: a Frame with no sequence number or timestamp
+    """
+    payload = np.asarray(ujson.loads(data.decode("utf8")), np.uint8)
+    return Frame(camera_id, 0, 0.0, CODEC_JPEG, payload)
+
+
+def decodeFrame(payload, flags=cv2.IMREAD_COLOR):
+    """Decodes an image payload directly from its buffer.
+        :param payload: encoded image bytes, memoryview or uint8 ndarray
+        :param flags: cv2.imread flags used for decoding
+        :returns: the decoded image as an ndarray, or None if decoding failed
+    """
+    return cv2.imdecode(np.frombuffer(payload, np.uint8), flags)
+
+
+def jpegSize(payload):
+    """Reads the dimensions of a JPEG image from its frame header without decoding it.
+        :param payload: JPEG bytes, memoryview or uint8 ndarray
+        :returns: (height, width)
+    """
+    data = memoryview(payload).cast("B")
+    i = 2
+    while i + 9 <= len(data):
+        if data[i] != 0xFF:
+            break
+        marker = data[i+1]
+        if marker == 0xFF: # fill byte
+            i += 1
+            continue
+        # start of frame markers, excluding DHT, JPG and DAC
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            return ((data[i+5] << 8) | data[i+6], (data[i+7] << 8) | data[i+8])
+        i += 2 + ((data[i+2] << 8) | data[i+3])
+    raise ValueError("payload has no JPEG frame header")
+
+
+class LazyFrame:
+    """Frame that is decoded on first use
+        The full resolution image and a copy reduced by a factor of reduction are
+        each decoded at most once. If the full image is already available it is
+        used in place of the reduced copy.
+    """
+    def __init__(self, payload=None, image=None, reduction=2):
+        """
+            :param payload: encoded JPEG image
+            :param image: an already decoded BGR image, used instead of payload
+            :param reduction: 1, 2, 4 or 8
+        """
+        self.payload = payload
+        self.reduction = reduction
+        self._full = image
+        self._reduced = None
+        self._mirrored = None
+
+    @property
+    def shape(self):
+        """(height, width) of the full resolution image"""
+        if self._full is not None:
+            return self._full.shape[:2]
+        return jpegSize(self.payload)
+
+    def full(self):
+        """:returns: the full resolution BGR image"""
+        if self._full is None:
+            self._full = decodeFrame(self.payload)
+        return self._full
+
+    def reduced(self):
+        """:returns: a reduced resolution BGR image, or the full image if it was already decoded"""
+        if self._full is not None:
+            return self._full
+        if self._reduced is None:
+            self._reduced = decodeFrame(self.payload, REDUCED_FLAGS[self.reduction])
+        return self._reduced
+
+    def mirroredReduced(self, buffers=None):
+        """
+            :param buffers: a backend.BufferPool to take the flipped image's memory from
+            :returns: the reduced resolution image flipped around the vertical axis
+        """
+        if self._mirrored is None:
+            reduced = self.reduced()
+            dst = None
+            if buffers is not None:
+                dst = buffers.get("mirrored", reduced.shape, host=True)
+            self._mirrored = cv2.flip(reduced, 1, dst)
+        return self._mirrored
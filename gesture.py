@@ -1,6 +1,7 @@
 import cv2
 import numpy as np
-import math
+
+from backend import toHost, BufferPool, BACKENDS
 
 class HandGestureRecognition:
     """Hand gesture recognition class
@@ -17,34 +18,53 @@ class HandGestureRecognition:
         """
         self.kernel = kernel = np.ones((3,3),np.uint8)
 
+        # hand regions are small, so they are segmented in host memory with
+        # buffers that are reused while the region keeps its size
+        self.buffers = BufferPool(BACKENDS["cpu"])
+
         # cut-off angle (deg): everything below this is a convexity point that
         # belongs to two extended fingers
         self.angle_cuttoff = 80.0
 
-    def recognize(self, img):
+    def recognize(self, img, annotate=True):
         """Recognizes hand gesture in a single-channel grayscale image
             This method estimates the number of extended fingers based on
             an image showing a hand region.
+            :param img: an ndarray, or a UMat when running on the OpenCL backend
+            :param annotate: return a color image of the hand region with the hull
+                                and defect points drawn on it
+            :returns: (num_fingers, annotated), annotated is None unless annotate is set
         """
         # further segment hand region
+        img = toHost(img)
         segment = self._segmentHand(img)
         try:
             # find the hull of the segmented area, and based on that find the
             # convexity defects
-            contours, defects = self._findHullDefects(segment)
-            return self._detectGesture(contours, defects, img)
+            contour, defects = self._findHullDefects(segment)
         except:
-            # detect the number of fingers depending on the contours and convexity
-            # defects, then draw defects that belong to fingers green, others red
-            segment = cv2.cvtColor(segment, cv2.COLOR_GRAY2BGR)
-            return (0,segment)
+            if not annotate:
+                return (0, None)
+            segment = cv2.cvtColor(segment, cv2.COLOR_GRAY2BGR,
+                                   self.buffers.get("annotated", segment.shape + (3,)))
+            return (0, segment)
+
+        # detect the number of fingers depending on the contours and convexity
+        # defects, then draw defects that belong to fingers green, others red
+        num_fingers, start, end, far, fingers = self._detectGesture(contour, defects)
+        if not annotate:
+            return (num_fingers, None)
+        img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR, self.buffers.get("annotated", img.shape + (3,)))
+        if start is not None:
+            self._drawDefects(img, start, end, far, fingers)
+        return (num_fingers, img)
 
     def _segmentHand(self, img):
         """This method applies further filtering to mitigate noise around masked hand
         """
-        mask = cv2.erode(img, self.kernel, iterations = 2)
-        mask = cv2.dilate(mask, self.kernel, iterations = 2)
-        mask = cv2.GaussianBlur(mask,(5,5),0)
+        mask = cv2.erode(img, self.kernel, self.buffers.get("eroded", img.shape), iterations = 2)
+        mask = cv2.dilate(mask, self.kernel, self.buffers.get("dilated", img.shape), iterations = 2)
+        mask = cv2.GaussianBlur(mask,(5,5),0, self.buffers.get("segment", img.shape))
         return mask
         
     def _findHullDefects(self, segment):
@@ -52,7 +72,8 @@ class HandGestureRecognition:
             This method finds all defects in the hull of a segmented arm
             region.
         """
-        _,contours,hierarchy = cv2.findContours(segment,cv2.RETR_EXTERNAL,cv2.CHAIN_APPROX_SIMPLE)
+        # OpenCV 3 also returns the image, the contours are second to last either way
+        contours = cv2.findContours(segment,cv2.RETR_EXTERNAL,cv2.CHAIN_APPROX_SIMPLE)[-2]
 
         # find largest area contour
         max_contour = max(contours, key = lambda x: cv2.contourArea(x))
@@ -65,62 +86,49 @@ class HandGestureRecognition:
 
         return (max_contour, defects)
 
-    def _detectGesture(self, contours, defects, img):
+    def _detectGesture(self, contour, defects):
         """Detects the number of extended fingers, based on a contour and
-            convexity defects. It will annotate an RGB color image of the
-            segmented hand region with all relevant defect points and the hull.
+            convexity defects. All defects are measured at once.
+            :returns: (num_fingers, start, end, far, fingers) where start, end and
+                        far are n x 2 arrays with the points of each defect and
+                        fingers is True for the defects between two extended
+                        fingers. The arrays are None if no fingers are extended
         """
-        img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
-
         # if there are no convexity defects, possibly no hull found or no
-        # fingers extended
-        if defects is None:
-            return ['0', img]
-
-        # assume the wrist generates two convexity defects (one on each
-        # side), so if there are no additional defect points, there are no
-        # fingers extended
-        if len(defects) <= 2:
-            return ['0', img]
-
-        # if there is a sufficient amount of convexity defects, we will find a
-        # defect point between two fingers so to get the number of fingers,
-        # start counting at 1
-        num_fingers = 1
-
-        for i in range(defects.shape[0]):
-            start_idx, end_idx, farthest_idx, _ = defects[i,0]
-            start = tuple(contours[start_idx][0])
-            end = tuple(contours[end_idx][0])
-            far = tuple(contours[farthest_idx][0])
-
-            # draw the hull
-            cv2.line(img, start, end, [0, 255, 0], 2)
-
-            # if angle is below a threshold, defect point belongs to two
-            # extended fingers
-            if angleRad(np.subtract(start, far),
-                        np.subtract(end, far)) < deg2Rad(self.angle_cuttoff):
-                num_fingers += 1
-
-                # draw point as green
-                cv2.circle(img, far, 5, [0, 255, 0], -1)
-            else:
-                # draw point as red
-                cv2.circle(img, far, 5, [0, 0, 255], -1)
-
-        return (min(5, num_fingers), img)
+        # fingers extended. Also assume the wrist generates two convexity
+        # defects (one on each side), so if there are no additional defect
+        # points, there are no fingers extended
+        if defects is None or defects.size // 4 <= 2:
+            return (0, None, None, None, None)
+
+        points = contour.reshape(-1, 2)
+        defects = defects.reshape(-1, 4)
+        start = points[defects[:, 0]]
+        end = points[defects[:, 1]]
+        far = points[defects[:, 2]]
+
+        # if angle is below a threshold, defect point belongs to two
+        # extended fingers
+        v1 = (start - far).astype(np.float64)
+        v2 = (end - far).astype(np.float64)
+        cross = v1[:, 0] * v2[:, 1] - v1[:, 1] * v2[:, 0]
+        dot = np.einsum("ij,ij->i", v1, v2)
+        fingers = np.arctan2(np.abs(cross), dot) < deg2Rad(self.angle_cuttoff)
+
+        # there is a defect point between two fingers, so to get the number
+        # of fingers, start counting at 1
+        num_fingers = min(5, 1 + int(np.count_nonzero(fingers)))
+        return (num_fingers, start, end, far, fingers)
+
+    def _drawDefects(self, img, start, end, far, fingers):
+        """Draws the hull, defect points between fingers green and other defect points red
+        """
+        cv2.polylines(img, np.stack((start, end), axis=1).astype(np.int32), False, [0, 255, 0], 2)
+        for point, finger in zip(far.tolist(), fingers.tolist()):
+            cv2.circle(img, tuple(point), 5, [0, 255, 0] if finger else [0, 0, 255], -1)
 
-def angleRad(v1, v2):
-    """Convert degrees to radians
-    This method converts an angle in radians e[0,2*np.pi) into degrees
-    e[0,360)
-    """
-    return np.arctan2(np.linalg.norm(np.cross(v1, v2)), np.dot(v1, v2))
-    
 def deg2Rad(angle_deg):
-    """Angle in radians between two vectors
-    returns the angle (in radians) between two array-like vectors
+    """Convert degrees to radians
     """
     return angle_deg/180.0*np.pi
     
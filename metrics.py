@@ -0,0 +1,186 @@
+"""
+Project: FandRec
+Description: Lightweight timing and rate metrics for the frame pipeline, served
+             by the /metrics route of the web server.
+Notes:
+    1. Collection is switched on by the first scrape of /metrics and switches
+       itself off again idle_timeout seconds after the last scrape. While it is
+       off, timers are a shared no-op object and observations return at once.
+    2. Histograms keep the most recent samples in a fixed size ring buffer, so
+       percentiles describe recent behaviour and memory use is bounded.
+    3. The registry is only used from the reactor thread. Worker processes time
+       their stages into a plain dict with timeStage and send it back with the
+       frame result.
+"""
+import time
+from collections import deque, OrderedDict
+
+import numpy as np
+
+
+class _NullTimer:
+    """Timer that does nothing, used while metrics are off"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_TIMER = _NullTimer()
+
+
+class StageTimer:
+    """Adds the milliseconds spent in a with block to times[name]"""
+    __slots__ = ("times", "name", "start")
+
+    def __init__(self, times, name):
+        self.times = times
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = (time.perf_counter() - self.start) * 1000
+        self.times[self.name] = self.times.get(self.name, 0.0) + elapsed
+        return False
+
+
+def timeStage(times, name):
+    """Times a stage into a dict of stage timings
+        :param times: dict of stage name to milliseconds, or None when timing is off
+        :param name: stage name
+        :returns: a context manager
+    """
+    if times is None:
+        return NULL_TIMER
+    return StageTimer(times, name)
+
+
+class Histogram:
+    """Rolling histogram of the most recent size samples"""
+    def __init__(self, size=1024):
+        self.values = np.zeros(size)
+        self.count = 0
+
+    def add(self, value):
+        self.values[self.count % len(self.values)] = value
+        self.count += 1
+
+    def summary(self):
+        values = self.values[:min(self.count, len(self.values))]
+        if not len(values):
+            return {"count": 0}
+        p50, p95, p99 = np.percentile(values, (50, 95, 99))
+        return OrderedDict([("count", self.count),
+                            ("mean", float(values.mean())),
+                            ("p50", float(p50)),
+                            ("p95", float(p95)),
+                            ("p99", float(p99)),
+                            ("max", float(values.max()))])
+
+
+class Rate:
+    """Events per second over a sliding window"""
+    def __init__(self, window=5.0):
+        self.window = window
+        self.events = deque()
+
+    def mark(self, now):
+        self.events.append(now)
+        self._expire(now)
+
+    def rate(self, now):
+        self._expire(now)
+        return len(self.events) / self.window
+
+    def _expire(self, now):
+        while self.events and self.events[0] < now - self.window:
+            self.events.popleft()
+
+
+class Metrics:
+    """Registry of per-camera histograms and rates"""
+    def __init__(self, idle_timeout=60.0, size=1024):
+        self.idle_timeout = idle_timeout
+        self.size = size
+        self.last_scrape = None
+        self.histograms = {}
+        self.rates = {}
+
+    @property
+    def enabled(self):
+        return (self.last_scrape is not None and
+                time.time() - self.last_scrape < self.idle_timeout)
+
+    def observe(self, camera, name, value):
+        """Adds a sample, in milliseconds, to a camera's histogram"""
+        if not self.enabled:
+            return
+        key = (camera, name)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(self.size)
+        histogram.add(value)
+
+    def observeAll(self, camera, times):
+        """Adds every entry of a dict of stage timings"""
+        if times:
+            for name, value in times.items():
+                self.observe(camera, name, value)
+
+    def timer(self, camera, name):
+        """:returns: a context manager timing its block into a camera's histogram"""
+        if not self.enabled:
+            return NULL_TIMER
+        return _ObserveTimer(self, camera, name)
+
+    def mark(self, camera, name):
+        """Counts an event towards a camera's per second rate"""
+        if not self.enabled:
+            return
+        key = (camera, name)
+        rate = self.rates.get(key)
+        if rate is None:
+            rate = self.rates[key] = Rate()
+        rate.mark(time.time())
+
+    def snapshot(self):
+        """Collects every histogram and rate, and keeps collection switched on
+            :returns: {camera: {"rates": {name: per second}, "stages": {name: summary}}}
+        """
+        now = time.time()
+        if not self.enabled:
+            # stale samples from an earlier scraping session
+            self.histograms.clear()
+            self.rates.clear()
+        self.last_scrape = now
+
+        cameras = OrderedDict()
+        for (camera, name), rate in sorted(self.rates.items()):
+            cameras.setdefault(camera, {"rates": {}, "stages": {}})["rates"][name] = rate.rate(now)
+        for (camera, name), histogram in sorted(self.histograms.items()):
+            cameras.setdefault(camera, {"rates": {}, "stages": {}})["stages"][name] = histogram.summary()
+        return cameras
+
+
+class _ObserveTimer:
+    __slots__ = ("metrics", "camera", "name", "start")
+
+    def __init__(self, metrics, camera, name):
+        self.metrics = metrics
+        self.camera = camera
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.camera, self.name, (time.perf_counter() - self.start) * 1000)
+        return False
+
+
+# registry used by the camera server
+metrics = Metrics()
@@ -0,0 +1,119 @@
+"""
+Project: FandRec
+Description: Loads the models used for recognition on first use or in parallel
+             in the background, instead of while recognition is imported.
+Notes:
+    1. A model is registered with a function that loads it and, optionally, one
+       that runs a warm-up inference on it. Nothing is loaded until the model is
+       first used or load is called.
+    2. load loads models on a thread each. OpenCV releases the GIL while it
+       reads model files, so the models load at the same time. A model that is
+       used while it is loading is waited for, and one that is used before load
+       is called is loaded by the thread that uses it.
+    3. The warm-up inference makes OpenCV allocate its buffers and, on the
+       OpenCL backend, compile its kernels before the first frame needs them.
+    4. The milliseconds spent loading and warming up each model are kept in
+       timings.
+"""
+import time, threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class ModelRegistry:
+    """Named models that are loaded once per process"""
+    def __init__(self):
+        # name to (loader, warmup)
+        self.loaders = OrderedDict()
+        # name to the Future of a model that is loaded or loading
+        self.futures = {}
+        self.warmed_up = set()
+        # name to {"load": ms, "warmup": ms}
+        self.timings = OrderedDict()
+        self.lock = threading.Lock()
+
+    def register(self, name, loader, warmup=None):
+        """
+            :param name: name the model is looked up by
+            :param loader: function that loads and returns the model
+            :param warmup: function run with the model to warm it up, if any
+        """
+        self.loaders[name] = (loader, warmup)
+
+    def get(self, name):
+        """:returns: the model, loading it in this thread if no thread has started to"""
+        future = self.futures.get(name)
+        if future is None:
+            future = self._load(name)
+        return future.result()
+
+    def load(self, names=None, warmup=False):
+        """Loads models in parallel and waits for them
+            :param names: models to load, every registered model by default
+            :param warmup: also run the warm-up inference of each model
+            :returns: dict of model name to the exception it failed with, empty
+                        if every model loaded
+        """
+        names = list(self.loaders) if names is None else list(names)
+        errors = {}
+
+        def prepare(name):
+            try:
+                model = self.get(name)
+                if warmup:
+                    self._warmUp(name, model)
+            except Exception as e:
+                errors[name] = e
+
+        threads = [threading.Thread(target=prepare, args=(name,), name="load " + name)
+                   for name in names]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return errors
+
+    def _load(self, name):
+        """Loads a model unless another thread already started to
+            :returns: the Future of the model
+        """
+        with self.lock:
+            future = self.futures.get(name)
+            if future is not None:
+                return future
+            future = self.futures[name] = Future()
+
+        loader = self.loaders[name][0]
+        start = time.perf_counter()
+        try:
+            future.set_result(loader())
+        except Exception as e:
+            future.set_exception(e)
+        self.timings.setdefault(name, OrderedDict())["load"] = (time.perf_counter() - start) * 1000
+        return future
+
+    def _warmUp(self, name, model):
+        warmup = self.loaders[name][1]
+        with self.lock:
+            if warmup is None or name in self.warmed_up:
+                return
+            self.warmed_up.add(name)
+        start = time.perf_counter()
+        warmup(model)
+        self.timings.setdefault(name, OrderedDict())["warmup"] = (time.perf_counter() - start) * 1000
+
+
+class Model:
+    """Class attribute that returns a model of a registry, so that the model is
+        loaded when it is first used instead of when the class is defined
+    """
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+
+    def __get__(self, instance, owner):
+        return self.registry.get(self.name)
+
+
+# models of this process, registered by the modules that use them
+models = ModelRegistry()
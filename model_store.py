@@ -0,0 +1,141 @@
+"""
+Project: FandRec
+Description: Append-only binary store for the training data of the face recognizer,
+             replacing the recognizer.yml that was rewritten on every registration.
+Notes:
+    1. A store is two files. <path>.data holds one segment per registration of a
+       user, <path>.index one fixed size entry per segment, laid out in network
+       byte order as
+           user id  4 bytes  signed
+           kind     1 byte   SAMPLES or EMBEDDING
+           offset   8 bytes  of the segment in the data file
+           count    4 bytes  number of samples the segment holds or sums
+           rows     4 bytes  \
+           cols     4 bytes  / shape of one sample or vector
+       after an 8 byte file header. SAMPLES segments are the 8-bit face images,
+       EMBEDDING segments the float32 feature sums of face_index.
+    2. Registering a user appends only that user's segments. Appends hold an
+       exclusive lock on the index while they write the data, then the index
+       entry, so cameras in other worker processes can register at the same
+       time. An entry whose data is incomplete, left by a crash, is ignored.
+    3. The data file is memory mapped, so loading the store parses no text and
+       the samples used to train the recognizer are views into the map.
+    4. Processes pick up segments appended by others by reading the index from
+       the last entry they read.
+    5. Recognition appends from its training thread, so registration does not
+       wait for the disk.
+"""
+import os, mmap, struct, fcntl
+from collections import namedtuple
+
+import numpy as np
+
+from face_index import lbpFeatures
+
+INDEX_HEADER = b"FRMI\0\0\0\2"
+DATA_HEADER = b"FRMD\0\0\0\1"
+ENTRY = struct.Struct("!iBQIII")
+
+# segment kinds
+SAMPLES = 1
+EMBEDDING = 2
+DTYPES = {SAMPLES: np.uint8, EMBEDDING: np.float32}
+
+# segments start at multiples of ALIGNMENT bytes so their arrays are aligned
+ALIGNMENT = 16
+
+Segment = namedtuple("Segment", ["user_id", "kind", "count", "array"])
+
+
+class ModelStore:
+    """Reads and appends the segments of a model store"""
+
+    def __init__(self, path):
+        """
+            :param path: path of the store without the .data/.index extension
+        """
+        self.path_data = path + ".data"
+        self.path_index = path + ".index"
+
+    def exists(self):
+        return os.path.isfile(self.path_index)
+
+    def size(self):
+        """:returns: number of bytes in the index, which changes whenever a segment is added"""
+        try:
+            return os.path.getsize(self.path_index)
+        except OSError:
+            return 0
+
+    def read(self, start=0):
+        """Reads the segments added since an earlier read
+            :param start: number of index entries already read
+            :returns: (segments, position) where position is the start to pass on the next read
+        """
+        if not self.exists():
+            return ([], start)
+        with open(self.path_index, "rb") as f:
+            header = f.read(len(INDEX_HEADER))
+            if not header: # created by a writer that has not written the header yet
+                return ([], start)
+            if header != INDEX_HEADER:
+                raise ValueError("{} is not a model store index".format(self.path_index))
+            f.seek(len(INDEX_HEADER) + start * ENTRY.size)
+            index = f.read()
+        # a partly written entry at the end is left for the next read
+        index = index[:len(index) - len(index) % ENTRY.size]
+        if not index:
+            return ([], start)
+
+        with open(self.path_data, "rb") as f:
+            data_size = os.fstat(f.fileno()).st_size
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        segments = []
+        position = start
+        for user_id, kind, offset, count, rows, cols in ENTRY.iter_unpack(index):
+            dtype = np.dtype(DTYPES[kind])
+            shape = (count, rows, cols) if kind == SAMPLES else (rows, cols)
+            length = int(np.prod(shape)) * dtype.itemsize
+            if offset + length > data_size: # data of an interrupted append
+                break
+            array = np.frombuffer(data, dtype, int(np.prod(shape)), offset).reshape(shape)
+            segments.append(Segment(user_id, kind, count, array))
+            position += 1
+        return (segments, position)
+
+    def append(self, user_id, kind, array, count):
+        """Appends one segment
+            :param kind: SAMPLES, array is count x rows x cols uint8, or EMBEDDING,
+                            array is a 1 x n float32 sum of count feature vectors
+        """
+        array = np.ascontiguousarray(array, DTYPES[kind])
+        rows, cols = array.shape[-2:]
+        os.makedirs(os.path.dirname(self.path_index) or ".", exist_ok=True)
+        with open(self.path_index, "ab") as index:
+            fcntl.flock(index, fcntl.LOCK_EX)
+            try:
+                if index.tell() == 0:
+                    index.write(INDEX_HEADER)
+                with open(self.path_data, "ab") as data:
+                    offset = data.tell()
+                    if offset == 0:
+                        data.write(DATA_HEADER)
+                        offset = len(DATA_HEADER)
+                    padding = -offset % ALIGNMENT
+                    data.write(b"\0" * padding)
+                    offset += padding
+                    data.write(array.tobytes())
+                    data.flush()
+                    os.fsync(data.fileno())
+                index.write(ENTRY.pack(user_id, kind, offset, count, rows, cols))
+                index.flush()
+            finally:
+                fcntl.flock(index, fcntl.LOCK_UN)
+
+    def appendUser(self, user_id, samples):
+        """Appends the samples of a registration together with their feature sum"""
+        samples = np.stack(samples)
+        features = np.stack([lbpFeatures(sample) for sample in samples])
+        self.append(user_id, SAMPLES, samples, len(samples))
+        self.append(user_id, EMBEDDING, features.sum(axis=0, keepdims=True), len(samples))
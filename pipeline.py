@@ -0,0 +1,443 @@
+"""
+Project: FandRec
+Description: Frame processing stage for the camera server. Frames are handed to
+             worker processes running Recognition.processFrame so that slow
+             frames never stall the Twisted reactor.
+Notes:
+    1. Each camera has a bounded queue of pending frames. When its worker falls
+       behind, the oldest pending frame is dropped in favour of the newest one.
+    2. Every camera is pinned to one worker process, which keeps a separate
+       Recognition (background model, trackers, registration state) for it.
+       The network weights are loaded once per worker and shared by all of the
+       cameras pinned to it.
+    3. A camera only ever has one frame in flight, so its Recognition state is
+       always updated in frame order.
+    4. A worker is sent the next frame of each of its cameras that has one
+       waiting, up to batch_size frames, and runs the face detection network
+       once for all of them. Detections are split back out per frame by the
+       image index the network reports with each detection. New cameras are
+       spread over the workers, so cameras only share a worker and its batches
+       once there are more cameras than workers. With cameras_per_worker set,
+       new cameras are instead packed onto a worker until it has that many
+       before the next worker is used. Packing trades the parallelism of
+       separate processes, as the rest of a batch's frames are processed one
+       after another, for fewer network runs.
+    5. Results are delivered back on the reactor thread.
+    6. When metrics are being collected, workers time each stage of a frame and
+       the timings are added to the metrics registry along with the queue wait
+       and total processing time.
+    7. Frames are only annotated and re-encoded when a viewer wants the server
+       to draw the overlay. Otherwise only the overlay metadata is returned and
+       the camera's original JPEG is forwarded as is, or nothing at all when the
+       camera has no viewers.
+    8. A camera with a latency budget has its face detection input size and
+       interval adjusted by the worker to keep its frames near the budget, so
+       a loaded server trades detection accuracy for keeping up.
+    9. warmUp starts every worker and has it load its models in parallel and
+       run a warm-up inference, so the first frames of cameras do not wait for
+       the models. The milliseconds each model took are kept in model_timings.
+   10. A worker process that dies, for example in native OpenCV or dlib code,
+       is replaced by a new one. Its cameras keep their worker but start over
+       with new Recognition state, and the frames it had in flight are counted
+       as failed.
+"""
+import os, time, multiprocessing, traceback
+from collections import deque, Counter, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import cv2
+
+from twisted.internet import reactor
+from twisted.python import log
+
+from backend import getBackend
+from frame_protocol import LazyFrame
+from metrics import metrics, timeStage
+
+#==========================Worker Process====================================
+
+# returned by a worker in place of a result, Twisted logging only runs on the reactor
+# so the error is logged there
+WorkerError = namedtuple("WorkerError", ["description", "traceback"])
+
+# Recognition instances owned by the worker process, keyed by camera id
+_cameras = {}
+
+def _initWorker():
+    """
+    Description: Loads the recognition models and selects the image backend once when
+                 the worker process starts.
+    """
+    import recognition
+    cv2.setNumThreads(1)
+    getBackend()
+
+def _warmUp():
+    """
+    Description: Loads the models in parallel and runs their warm-up inference, then loads
+                 the face recognizer, before the worker's first frame needs them.
+    Output: (timings, errors), dicts of model name to its load and warm-up milliseconds
+            and of model name to the error it failed to load with
+    """
+    from recognition import Recognition
+    from model_registry import models
+    errors = models.load(warmup = True)
+    start = time.perf_counter()
+    Recognition._loadRecognizer()
+    timings = dict(models.timings)
+    timings["recognizer"] = {"load": (time.perf_counter() - start) * 1000}
+    return (timings, {name: str(error) for name, error in errors.items()})
+
+def _recognition(camera_id, start_registration, annotate, latency_budget, timed):
+    """
+    Description: Returns the Recognition of a camera, created on its first frame, set up
+                 for the next frame.
+    """
+    rec = _cameras.get(camera_id)
+    if rec is None:
+        from recognition import Recognition
+        rec = _cameras[camera_id] = Recognition()
+    if start_registration:
+        rec.is_registering = True
+    rec.annotate = annotate
+    rec.setLatencyBudget(latency_budget)
+    rec.stage_times = {} if timed else None
+    return rec
+
+def _processBatch(jobs, timed):
+    """
+    Description: Processes one frame from each of several cameras inside the worker.
+                 The face detection network is run once for the frames in the batch
+                 that need it, per network input size, then each frame is processed
+                 and, if annotate is set, re-encoded. The time spent on each frame is
+                 reported to its camera's latency budget.
+    Usage: jobs  --  list of (camera_id, payload, username, start_registration, annotate,
+                              latency_budget)
+    Output: (results, errors), a list with, for each job, (jpeg, username, gesture,
+            reg_complete, overlay, stage_times) or the WorkerError it failed with, and
+            a list of the WorkerErrors of batched detection. jpeg is None when the frame
+            was not annotated and stage_times is None unless timed
+    """
+    from recognition import Recognition
+    recs = [_recognition(camera_id, start_registration, annotate, latency_budget, timed)
+            for camera_id, payload, username, start_registration, annotate, latency_budget in jobs]
+    frames = [LazyFrame(job[1]) for job in jobs]
+    # milliseconds spent on each frame
+    spent = [0.0] * len(jobs)
+
+    # frames can only share a batch if their cameras use the same network input size
+    batches = {}
+    for i, rec in enumerate(recs):
+        if jobs[i][2] is not None and rec.needsDetection():
+            batches.setdefault(rec.face_input_size, []).append(i)
+
+    detections = [None] * len(jobs)
+    errors = []
+    for size, batch in batches.items():
+        if len(batch) < 2:
+            continue
+        start = time.perf_counter()
+        images = []
+        for i in batch:
+            with timeStage(recs[i].stage_times, "decode_reduced"):
+                images.append(frames[i].mirroredReduced(recs[i].buffers))
+        detect_start = time.perf_counter()
+        try:
+            for i, detected in zip(batch, Recognition.detectFaces(images, size)):
+                detections[i] = detected
+        except Exception:
+            # the frames fall back to detecting their faces one at a time
+            errors.append(WorkerError("Batched face detection failed", traceback.format_exc()))
+        # every frame is charged an equal share of the batch
+        end = time.perf_counter()
+        share = (end - detect_start) * 1000 / len(batch)
+        for i in batch:
+            spent[i] += (end - start) * 1000 / len(batch)
+            if recs[i].stage_times is not None:
+                recs[i].stage_times["detect"] = share
+
+    results = []
+    for i, (camera_id, payload, username, start_registration, annotate, latency_budget) \
+            in enumerate(jobs):
+        start = time.perf_counter()
+        try:
+            results.append(_processFrame(recs[i], frames[i], username, annotate, detections[i]))
+        except Exception:
+            results.append(WorkerError("Frame processing failed for {}".format(camera_id),
+                                       traceback.format_exc()))
+            continue
+        recs[i].recordLatency(spent[i] + (time.perf_counter() - start) * 1000)
+    return (results, errors)
+
+def _processFrame(rec, frame, username, annotate, detections):
+    """
+    Description: Processes and, if annotate is set, re-encodes one frame inside the worker.
+    """
+    gesture = '0'
+    overlay = {}
+    if username is not None:
+        frame, username, gesture = rec.processFrame(frame, username, detections)
+        overlay = rec.overlay
+    else:
+        frame = frame.full() if annotate else None
+
+    jpeg = None
+    if annotate:
+        with timeStage(rec.stage_times, "encode"):
+            jpeg = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 20])[1].tobytes()
+    return (jpeg, username, gesture, rec.reg_complete, overlay, rec.stage_times)
+
+def _removeCamera(camera_id):
+    """
+    Description: Discards the Recognition state of a disconnected camera.
+    """
+    _cameras.pop(camera_id, None)
+
+#==========================Frame Pipeline====================================
+
+class FramePipeline():
+    """
+    Description: Queues frames per camera and runs them through the worker processes.
+    Usage: FramePipeline(callback, queue_size, num_workers, batch_size, batch_wait,
+                         latency_budget, cameras_per_worker)
+        callback    --  called on the reactor as callback(camera_id, payload, result, received)
+                        where payload is the camera's original JPEG, result is
+                        (jpeg, username, gesture, reg_complete, overlay) and received
+                        is the time the frame was submitted
+        queue_size  --  number of frames a camera may have waiting
+        num_workers --  number of worker processes, defaults to one per CPU core.
+                        Workers are only started once a camera is assigned to them
+                        or warmUp is called.
+        batch_size  --  most frames, one per camera, sent to a worker at once
+        batch_wait  --  seconds an idle worker waits for more of its cameras to have
+                        a frame ready before it starts on a partial batch
+        latency_budget -- milliseconds a camera's frames should take to process.
+                          Face detection is made cheaper or more accurate to stay
+                          near it. None keeps face detection at its defaults.
+        cameras_per_worker -- pack this many cameras onto a worker, at most batch_size,
+                              before the next one is used. Once every worker has this
+                              many, cameras are spread over the least loaded workers.
+                              None spreads cameras over the least loaded workers from
+                              the start.
+    """
+    def __init__(self, callback, queue_size = 1, num_workers = None,
+                 batch_size = 8, batch_wait = 0.0, latency_budget = None,
+                 cameras_per_worker = None):
+        self.callback = callback
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.cameras_per_worker = None
+        if cameras_per_worker is not None:
+            self.cameras_per_worker = max(1, min(cameras_per_worker, batch_size))
+        self.batch_wait = batch_wait
+        self.latency_budget = latency_budget
+        # latency budgets of cameras that do not use the default
+        self.latency_budgets = {}
+        self.workers = [self._startWorker() for i in range(num_workers or os.cpu_count() or 1)]
+        # camera id to the index of its worker
+        self.assigned = {}
+        self.pending = {}
+        # worker index to the (camera_id, payload, received) of every frame in flight
+        self.busy = {}
+        # worker index to the delayed call that starts its next partial batch
+        self.waiting = {}
+        self.start_registration = set()
+
+        # frame counters, keyed by camera id
+        self.processed = Counter()
+        self.dropped = Counter()
+        self.failed = Counter()
+        # sum over a camera's frames of the number of frames in their batch
+        self.batch_frames = Counter()
+
+        # worker index to the milliseconds its models took to load, once warmed up
+        self.model_timings = {}
+
+    def submit(self, camera_id, payload, username, annotate = True):
+        """
+        Description: Queues a frame for processing, dropping the oldest waiting frame
+                     of the camera if its queue is full.
+        Usage: annotate  --  draw the overlay on the frame and return it re-encoded
+        """
+        queue = self.pending.get(camera_id)
+        if queue is None:
+            queue = self.pending[camera_id] = deque(maxlen = self.queue_size)
+            self.assigned[camera_id] = self._assignWorker()
+        if len(queue) == queue.maxlen:
+            self.dropped[camera_id] += 1
+        queue.append((bytes(payload), username, annotate, time.time()))
+        self._schedule(self.assigned[camera_id])
+
+    def removeCamera(self, camera_id):
+        """
+        Description: Drops the pending frames and worker state of a disconnected camera.
+        """
+        if camera_id in self.pending:
+            del self.pending[camera_id]
+            try:
+                self.workers[self.assigned.pop(camera_id)].submit(_removeCamera, camera_id)
+            except BrokenProcessPool:
+                # the camera's state died with the worker, which is replaced with its next frame
+                pass
+
+    def setLatencyBudget(self, camera_id, target):
+        """
+        Description: Sets the milliseconds per frame one camera should take, None
+                     for no budget.
+        """
+        self.latency_budgets[camera_id] = target
+
+    def startRegistration(self, camera_id):
+        """
+        Description: Puts the camera's recognizer into registration mode with its next frame.
+        """
+        self.start_registration.add(camera_id)
+
+    def stats(self):
+        """
+        Description: Returns the queue depth, frame counters and mean number of frames
+                     per batch of every camera
+        """
+        in_flight = set(job[0] for jobs in self.busy.values() for job in jobs)
+        return {camera_id: {"queue_depth": len(queue) + (camera_id in in_flight),
+                            "processed": self.processed[camera_id],
+                            "dropped": self.dropped[camera_id],
+                            "failed": self.failed[camera_id],
+                            "mean_batch": self.batch_frames[camera_id] /
+                                          max(self.processed[camera_id] + self.failed[camera_id], 1)}
+                for camera_id, queue in self.pending.items()}
+
+    def warmUp(self):
+        """
+        Description: Starts every worker and loads its models in the background.
+        """
+        for worker, executor in enumerate(self.workers):
+            future = executor.submit(_warmUp)
+            future.add_done_callback(
+                lambda f, worker = worker: reactor.callFromThread(self._warmedUp, worker, f))
+
+    def shutdown(self):
+        for call in self.waiting.values():
+            call.cancel()
+        self.waiting.clear()
+        for worker in self.workers:
+            worker.shutdown(wait = False)
+
+    def _warmedUp(self, worker, future):
+        try:
+            timings, errors = future.result()
+        except Exception:
+            log.err(None, "Loading the models failed on worker {}".format(worker))
+            return
+        for name, error in errors.items():
+            log.msg("Worker {} could not load {}: {}".format(worker, name, error))
+        self.model_timings[worker] = timings
+        log.msg("Worker {} models ready: {}".format(worker, ", ".join(
+            "{} {}".format(name, " ".join("{} {:.0f} ms".format(step, ms) for step, ms in steps.items()))
+            for name, steps in timings.items())))
+
+    def _startWorker(self):
+        return ProcessPoolExecutor(max_workers = 1,
+                                   mp_context = multiprocessing.get_context("spawn"),
+                                   initializer = _initWorker)
+
+    def _restartWorker(self, worker):
+        """
+        Description: Replaces a worker process that died with a new one.
+        """
+        log.msg("Worker {} stopped unexpectedly, restarting it".format(worker), isError = True)
+        self.workers[worker].shutdown(wait = False)
+        self.workers[worker] = self._startWorker()
+        self.model_timings.pop(worker, None)
+
+    def _assignWorker(self):
+        """
+        Description: Returns the worker for a new camera, the least loaded one unless
+                     cameras are packed, then the busiest worker with fewer than
+                     cameras_per_worker cameras if there is one.
+        """
+        load = Counter(self.assigned.values())
+        workers = range(len(self.workers))
+        open_workers = []
+        if self.cameras_per_worker is not None:
+            open_workers = [worker for worker in workers if load[worker] < self.cameras_per_worker]
+        if open_workers:
+            return max(open_workers, key = lambda worker: (load[worker], -worker))
+        return min(workers, key = lambda worker: load[worker])
+
+    def _ready(self, worker):
+        """
+        Description: Returns the cameras of a worker that have a frame waiting, oldest frame first
+        """
+        ready = [camera_id for camera_id, assigned in self.assigned.items()
+                 if assigned == worker and self.pending[camera_id]]
+        return sorted(ready, key = lambda camera_id: self.pending[camera_id][0][3])
+
+    def _schedule(self, worker):
+        if worker in self.busy:
+            return
+        ready = len(self._ready(worker))
+        if worker in self.waiting:
+            if ready >= self.batch_size:
+                self.waiting.pop(worker).cancel()
+                self._dispatch(worker)
+        elif ready >= self.batch_size or (ready and self.batch_wait <= 0):
+            self._dispatch(worker)
+        elif ready:
+            self.waiting[worker] = reactor.callLater(self.batch_wait, self._dispatch, worker)
+
+    def _dispatch(self, worker):
+        self.waiting.pop(worker, None)
+        jobs = []
+        in_flight = []
+        for camera_id in self._ready(worker)[:self.batch_size]:
+            payload, username, annotate, received = self.pending[camera_id].popleft()
+            start_registration = camera_id in self.start_registration
+            self.start_registration.discard(camera_id)
+            metrics.observe(camera_id, "queue_wait", (time.time() - received) * 1000)
+            latency_budget = self.latency_budgets.get(camera_id, self.latency_budget)
+            jobs.append((camera_id, payload, username, start_registration, annotate,
+                         latency_budget))
+            in_flight.append((camera_id, payload, received))
+        if not jobs:
+            return
+
+        try:
+            future = self.workers[worker].submit(_processBatch, jobs, metrics.enabled)
+        except BrokenProcessPool:
+            # the worker died after its last batch, while removing a camera or warming up
+            self._restartWorker(worker)
+            future = self.workers[worker].submit(_processBatch, jobs, metrics.enabled)
+        for camera_id, payload, received in in_flight:
+            self.batch_frames[camera_id] += len(jobs)
+        self.busy[worker] = in_flight
+        future.add_done_callback(lambda f: reactor.callFromThread(self._done, worker, f))
+
+    def _done(self, worker, future):
+        in_flight = self.busy.pop(worker)
+        try:
+            results, errors = future.result()
+        except BrokenProcessPool:
+            self._restartWorker(worker)
+            results = [None] * len(in_flight)
+            errors = []
+        except Exception:
+            log.err(None, "Frame processing failed on worker {}".format(worker))
+            results = [None] * len(in_flight)
+            errors = []
+        for error in errors:
+            log.msg("{} on worker {}:\n{}".format(error.description, worker, error.traceback),
+                    isError = True)
+        for (camera_id, payload, received), result in zip(in_flight, results):
+            if result is None or isinstance(result, WorkerError):
+                self.failed[camera_id] += 1
+                if result is not None:
+                    log.msg("{}:\n{}".format(result.description, result.traceback), isError = True)
+                continue
+            self.processed[camera_id] += 1
+            metrics.mark(camera_id, "fps")
+            metrics.observe(camera_id, "total", (time.time() - received) * 1000)
+            metrics.observeAll(camera_id, result[5])
+            self.callback(camera_id, payload, result[:5], received)
+        self._schedule(worker)
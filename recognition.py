@@ -1,7 +1,15 @@
-import sys, cv2, numpy as np, os, time, dlib, imutils
+import sys, cv2, numpy as np, os, time, threading, dlib, imutils
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from gesture import *
+from gesture import HandGestureRecognition
 from database import DBHelper
+from frame_protocol import LazyFrame
+from backend import getBackend, toHost, BufferPool
+from face_index import EmbeddingRecognizer, lbpFeatures
+from model_store import ModelStore, SAMPLES, EMBEDDING
+from metrics import timeStage
+from model_registry import models, Model
 from imutils.video import WebcamVideoStream
 DBHelper = DBHelper.DBHelper
 
@@ -18,11 +26,97 @@ class Recognition:
     # global class variables
     path_facemodel = "./models/face_classifier.caffemodel"
     path_faceproto = "./models/face_classifier.prototxt.txt"
-    facenet = cv2.dnn.readNetFromCaffe(path_faceproto, path_facemodel)
-    hand_classifier = cv2.CascadeClassifier("./models/aGest.xml")
-    gesture_recognizer = HandGestureRecognition()
+    path_handmodel = "./models/aGest.xml"
+
+    # face recognizer backend: "lbph" for OpenCV's LBPH recognizer, which compares a face
+    # with every stored sample, or "embedding" for face_index.EmbeddingRecognizer, which
+    # keeps one vector per user. A face is recognized when the distance the recognizer
+    # reports is at or below the backend's threshold
+    recognizer_backend = os.environ.get("FANDREC_RECOGNIZER", "lbph")
+    recognizer_thresholds = {"lbph": 80, "embedding": 0.15}
+    if recognizer_backend not in recognizer_thresholds:
+        print("FANDREC_RECOGNIZER={} is not one of {}, using lbph".format(
+            recognizer_backend, ", ".join(recognizer_thresholds)))
+        recognizer_backend = "lbph"
+    recognizer_threshold = recognizer_thresholds[recognizer_backend]
+
+    # training data is appended to a binary model store, one segment per registration.
+    # A recognizer.yml saved by earlier versions is still read as the base LBPH model
+    model_store = ModelStore("./training_data/faces")
+    path_recognizer = "./training_data/recognizer.yml"
+
+    # shared models, loaded when first used or by models.load
+    facenet = Model(models, "facenet")
+    hand_classifier = Model(models, "hand_classifier")
+    gesture_recognizer = Model(models, "gesture_recognizer")
     font = cv2.FONT_HERSHEY_SIMPLEX
+    # registration looks at the faces of sample_size frames and keeps the sample_budget
+    # most diverse of them for training
     sample_size = 100
+    sample_budget = 30
+
+    # detections of the face network below face_confidence are discarded. If
+    # face_nms_threshold is set, overlapping detections whose intersection over
+    # union is above it are suppressed in favour of the most confident one
+    face_confidence = 0.4
+    face_nms_threshold = None
+
+    # per channel mean subtracted from the face network input
+    face_mean = np.array([104.0, 177.0, 123.0], np.float32).reshape(3, 1, 1)
+
+    # while detecting, faces are found by the neural network every face_detect_interval
+    # frames and followed with correlation trackers in between. The network is run
+    # early if a tracker's quality drops below face_track_quality. An interval of 1
+    # runs the network on every frame.
+    face_detect_interval = 5
+    face_track_quality = 7.0
+
+    # side of the square face network input. It can be raised up to 300 for improved
+    # accuracy or lowered to 100 for faster performance and worse accuracy. Both
+    # this and face_detect_interval are adjusted per camera while it has a latency budget
+    face_input_size = 150
+
+    # hands are only searched for in a band on each side of a recognized face, reaching
+    # hand_search_width face widths out from the face and from hand_search_above face
+    # heights above it to hand_search_below face heights below it. Hands are expected
+    # to be hand_size_range face widths in size
+    hand_search_width = 3.0
+    hand_search_above = 0.5
+    hand_search_below = 1.5
+    hand_size_range = (0.4, 1.5)
+
+    # weight of new frames when the background model adapts to lighting changes while
+    # a hand is tracked, 0 keeps the background from calibration
+    background_adapt_rate = 0.05
+
+    # identities of tracked faces are cached and only checked with the recognizer
+    # again every identity_verify_interval frames, when the track is lost or when
+    # the recognizer changes
+    identity_verify_interval = 30
+
+    # user id to username, loaded from the database when an unknown id is seen
+    usernames = {}
+    usernames_loaded = 0
+
+    # the face recognizer is shared by every instance in the process and updated
+    # when another process adds training data to the model store
+    recognizer = None
+    recognizer_trained = False
+    recognizer_checked = 0
+    recognizer_check_interval = 1.0
+    recognizer_version = 0
+
+    # registrations are trained on a background thread that builds a new recognizer
+    # and swaps it in for the shared one. Detection keeps using the previous recognizer
+    # until then. The thread holds recognizer_lock while it saves and trains, and the
+    # store is not read for other processes' training data meanwhile
+    trainer = ThreadPoolExecutor(max_workers=1)
+    recognizer_lock = threading.Lock()
+
+    # number of model store index entries applied to the recognizer, and the index
+    # size when they were read
+    store_position = 0
+    store_size = 0
 
     
     def __init__(self):
@@ -30,75 +124,367 @@ class Recognition:
         # instance variables
         self.frame_dimensions = None
         self.samples = 0
-        self.sample_images = []
+        self.sample_selector = SampleSelector(self.sample_budget)
         self.gesture_tracker = None
+        self.face_trackers = []
+        self.frames_since_detect = 0
         self.last_gest = ""
-        self.rec_trained = False
-        self.black_mask = np.zeros((480,640),np.uint8)
-        self.bg_model = BackgroundModel()
+
+        # LatencyBudget adjusting face detection to a target time per frame, if any
+        self.latency = None
+
+        # full resolution frames are processed on the CPU or through OpenCL, with
+        # the intermediate images of every stage kept between frames
+        self.backend = getBackend()
+        self.buffers = BufferPool(self.backend)
+        self.bg_model = BackgroundModel(self.backend, adapt_rate=self.background_adapt_rate)
         
         
         # bools for altering webpage control flow
         self.is_registering = False
         self.reg_complete = False
+
+        # training of this camera's last registration, while it runs
+        self.training = None
+
+        # when annotate is False nothing is drawn on frames, viewers draw the
+        # overlay metadata themselves
+        self.annotate = True
+        self.overlay = {}
+
+        # dict that processFrame adds the milliseconds spent in each stage to,
+        # None while stage timing is off
+        self.stage_times = None
         
-        # initialize OpenCV's local binary pattern histogram recognizer
-        # and load saved training data
-        self.recognizer = cv2.face.LBPHFaceRecognizer_create()
-        if Path('./training_data/recognizer.yml').is_file():
-            self.recognizer.read('./training_data/recognizer.yml')
-            self.rec_trained = True
+        # load saved training data
+        self._loadRecognizer()
+
+    @property
+    def rec_trained(self):
+        return Recognition.recognizer_trained
+
+    @classmethod
+    def _loadRecognizer(cls):
+        """Creates the shared face recognizer and adds training data appended to the model
+            store since it was last read. Checks at most once per check interval.
+        """
+        now = time.time()
+        if cls.recognizer is not None and now - cls.recognizer_checked < cls.recognizer_check_interval:
+            return
+        cls.recognizer_checked = now
+
+        if cls.recognizer is None:
+            with cls.recognizer_lock:
+                if cls.recognizer is None:
+                    cls._swapRecognizer(cls._buildRecognizer())
+            return
+
+        # the training thread reads the store itself when it swaps its recognizer in
+        if not cls.recognizer_lock.acquire(blocking=False):
+            return
+        try:
+            size = cls.model_store.size()
+            if size == cls.store_size:
+                return
+            cls.store_size = size
+            segments, cls.store_position = cls.model_store.read(cls.store_position)
+            if cls._trainSegments(cls.recognizer, segments):
+                cls.recognizer_trained = True
+                cls.recognizer_version += 1
+        finally:
+            cls.recognizer_lock.release()
+
+    @classmethod
+    def _buildRecognizer(cls):
+        """Creates a recognizer trained on the legacy model and the whole model store
+            :returns: (recognizer, trained, store_position, store_size) to pass to _swapRecognizer
+        """
+        trained = False
+        if cls.recognizer_backend == "embedding":
+            recognizer = EmbeddingRecognizer()
+        else:
+            recognizer = cv2.face.LBPHFaceRecognizer_create()
+            if Path(cls.path_recognizer).is_file():
+                recognizer.read(cls.path_recognizer)
+                trained = True
+
+        size = cls.model_store.size()
+        segments, position = cls.model_store.read()
+        if cls._trainSegments(recognizer, segments):
+            trained = True
+        return (recognizer, trained, position, size)
+
+    @classmethod
+    def _swapRecognizer(cls, built):
+        """Replaces the shared recognizer with one returned by _buildRecognizer, unless
+            the shared one already holds more of the store. Called with recognizer_lock held
+            :returns: True if the recognizer was replaced
+        """
+        if cls.recognizer is not None and built[2] < cls.store_position:
+            return False
+        cls.recognizer, cls.recognizer_trained, cls.store_position, cls.store_size = built
+        cls.recognizer_version += 1
+        return True
+
+    @classmethod
+    def _train(cls, user_id, samples):
+        """Saves the samples of a registration, builds a recognizer that includes them
+            and swaps it in. Runs on the training thread, so the registration is loaded
+            even if its camera disconnects before the training finishes.
+        """
+        with cls.recognizer_lock:
+            cls.model_store.appendUser(user_id, samples)
+            cls._swapRecognizer(cls._buildRecognizer())
+
+    @classmethod
+    def _trainSegments(cls, recognizer, segments):
+        """Adds model store segments to a recognizer
+            :returns: True if the recognizer changed
+        """
+        if cls.recognizer_backend == "embedding":
+            segments = [segment for segment in segments if segment.kind == EMBEDDING]
+            if not segments:
+                return False
+            recognizer.updateSums([segment.user_id for segment in segments],
+                                  [segment.array for segment in segments],
+                                  [segment.count for segment in segments])
+        else:
+            segments = [segment for segment in segments if segment.kind == SAMPLES]
+            if not segments:
+                return False
+            images = [sample for segment in segments for sample in segment.array]
+            labels = np.concatenate([np.full(segment.count, segment.user_id, np.int32)
+                                     for segment in segments])
+            recognizer.update(images, labels)
+        return True
+
+    @classmethod
+    def _lookupUsername(cls, user_id):
+        """Resolves a user id from the in-memory user map, reloading the map from the
+            database at most once per second when the id is missing.
+            :returns: the username, or "NoUserExists"
+        """
+        username = cls.usernames.get(user_id)
+        if username is None and time.time() - cls.usernames_loaded >= 1.0:
+            cls.usernames = DBHelper().getUserMap()
+            cls.usernames_loaded = time.time()
+            username = cls.usernames.get(user_id)
+        return username if username is not None else "NoUserExists"
         
 
-    def processFrame(self, frame, username):
+    def processFrame(self, frame, username, detections=None):
         """Prepares frame for either face recognition or hand gesture detection and
             performs additional processing for display.
-            :param frame:
+            Faces are detected on a reduced resolution copy of the frame. The full
+            resolution frame is only decoded when faces are found, a hand is tracked,
+            the background model is calibrating or the frame is annotated for display.
+            :param frame: a BGR ndarray or a LazyFrame
             :param username:
+            :param detections: raw face network output for this frame from detectFaces,
+                                used instead of running the network if detection is needed
             :returns: (frame, username, gesture), processed frame, a name of a recognized
-                        user, and the id number of a detected hand gesture
+                        user, and the id number of a detected hand gesture. frame is None
+                        if the full resolution frame was not needed or not annotated, and
+                        its memory is reused by the next call
         """
+        source = frame if isinstance(frame, LazyFrame) else LazyFrame(image=frame)
+
         # get frame height and width
         if self.frame_dimensions is None:
-            self.frame_dimensions = frame.shape[:2]
-        
-        # mirror and split raw frame into color, grayscale
-        frame = cv2.UMat(frame)
-        frame = cv2.flip(frame, 1)
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-
-        # equalizing the histogram improves results for detection algorithms
-        # in varying lighting conditions
-        gray = cv2.equalizeHist(gray)
-        frame = cv2.UMat.get(frame)
-        
+            self.frame_dimensions = source.shape
+
+        # pick up training data saved by other processes
+        self._loadRecognizer()
+
         # reg_complete bool indicates whether registration has been completed
         # during this method call
         self.reg_complete = False
+        if self.training is not None and self.training.done():
+            self._finishTraining()
+        h, w = self.frame_dimensions
+        self.overlay = {"size": [w, h], "faces": [], "hand": None}
+
+        # set before the early returns so viewers drawing the overlay get them on
+        # every frame, and updated once the frame is processed
+        if self.is_registering:
+            self.overlay["progress"] = int(self.samples/self.sample_size*100)
+        elif self.rec_trained:
+            self.overlay["gesture"] = self.last_gest
 
         gesture = '0'  # default value will not send tag
+
+        # detection only needs the reduced frame, mirrored like the full frame
+        faces = None
+        if self.is_registering and self.samples < self.sample_size:
+            faces = self._findFacesReduced(source, detections=detections)
+            if not len(faces) and not self.annotate:
+                return (None, username, gesture)
+        elif not self.is_registering and self.rec_trained and self.gesture_tracker is None:
+            faces = self._findFacesReduced(source, track=True, detections=detections)
+            if not len(faces) and not self.annotate and self.bg_model.calibrated:
+                return (None, "", gesture)
+        elif not self.is_registering and not self.rec_trained and not self.annotate:
+            return (None, username, gesture)
+        
+        with timeStage(self.stage_times, "decode_full"):
+            frame = source.full()
+
+        # mirror and split raw frame into color, grayscale. Both stay in the
+        # backend's memory until the annotated frame is returned
+        with timeStage(self.stage_times, "preprocess"):
+            frame = self.backend.upload(frame)
+            frame = cv2.flip(frame, 1, self.buffers.get("frame", (h, w, 3)))
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, self.buffers.get("gray", (h, w)))
+
+            # equalizing the histogram improves results for detection algorithms
+            # in varying lighting conditions
+            gray = cv2.equalizeHist(gray, self.buffers.get("equalized", (h, w)))
         
         if self.is_registering:
-            frame = self._register(frame, gray, username)
-            self._displayProgress(frame)
+            frame = self._register(frame, gray, username, faces)
+            self.overlay["progress"] = int(self.samples/self.sample_size*100)
+            if self.annotate:
+                self._displayProgress(frame)
         elif self.rec_trained:
-            frame, username, gesture = self._detect(frame, gray)
-            self._displayGesture(frame)
-        
-        return (frame, username, gesture)
+            frame, username, gesture = self._detect(frame, gray, faces)
+            self.overlay["gesture"] = self.last_gest
+            if self.annotate:
+                self._displayGesture(frame)
+
+        if not self.annotate:
+            return (None, username, gesture)
+        return (toHost(frame), username, gesture)
         
     
-    def _register(self, frame, gray, username):
+    def needsDetection(self):
+        """:returns: True if the next processFrame call will run the face detection network,
+                        unless a face tracker loses its face
+        """
+        if self.is_registering:
+            return self.samples < self.sample_size
+        return (self.rec_trained and self.gesture_tracker is None and
+                (not self.face_trackers or self.frames_since_detect >= self.face_detect_interval - 1))
+
+    def setLatencyBudget(self, target):
+        """Sets the time this camera's frames should take to process
+            :param target: milliseconds per frame, or None to detect faces with the
+                            class defaults
+        """
+        if target is None:
+            self.latency = None
+            self.__dict__.pop("face_input_size", None)
+            self.__dict__.pop("face_detect_interval", None)
+        elif self.latency is None:
+            self.latency = LatencyBudget(target, self.face_input_size, self.face_detect_interval)
+        else:
+            self.latency.target = target
+
+    def recordLatency(self, frame_ms):
+        """Reports how long the last frame took and applies any change the latency
+            budget makes to face detection
+            :param frame_ms: milliseconds spent on the frame, including its share of
+                                batched detection
+        """
+        if self.latency is not None and self.latency.update(frame_ms):
+            self.face_input_size, self.face_detect_interval = self.latency.setting()
+
+    @classmethod
+    def detectFaces(cls, frames, size=None):
+        """Runs the face detection network once on a batch of frames
+            :param frames: 8-bit, 3-channel ndarrays of any size
+            :param size: side of the network input, defaults to face_input_size
+            :returns: list with the raw network output for each frame, in the format
+                        _findFaces expects
+        """
+        size = (size or cls.face_input_size,) * 2
+        blob = cv2.dnn.blobFromImages([cv2.resize(frame, size) for frame in frames], 1.0,
+                                      size, (104.0, 177.0, 123.0))
+        cls.facenet.setInput(blob)
+        detected_faces = cls.facenet.forward()
+
+        # the first column of every detection is the index of its frame in the batch
+        image_ids = detected_faces[0,0,:,0]
+        return [detected_faces[:,:,image_ids == i] for i in range(len(frames))]
+
+
+    def _findFacesReduced(self, source, track=False, detections=None):
+        """Detects faces on the mirrored, reduced resolution copy of a frame
+            :param source: a LazyFrame
+            :param track: follow faces with trackers between runs of the detector
+            :param detections: raw face network output for this frame, if already available
+            :returns: face regions in full resolution frame coordinates
+        """
+        with timeStage(self.stage_times, "decode_reduced"):
+            small = source.mirroredReduced(self.buffers)
+
+        if not track:
+            self.face_trackers = []
+            return self._findFaces(small, detections)
+
+        if self.face_trackers and self.frames_since_detect < self.face_detect_interval - 1:
+            faces = self._trackFaces(small)
+            if faces is not None:
+                self.frames_since_detect += 1
+                return faces
+
+        faces = self._findFaces(small, detections)
+        self.frames_since_detect = 0
+        scale = small.shape[1] / self.frame_dimensions[1]
+        trackers = []
+        for face in faces:
+            tracker = FaceTracker(small, [int(c * scale) for c in face])
+
+            # keep the identity of a face that was already being tracked
+            overlaps = [(intersectionOverUnion(tracker.box, old.box), old) for old in self.face_trackers]
+            if overlaps:
+                overlap, old = max(overlaps, key=lambda pair: pair[0])
+                if overlap >= 0.3:
+                    tracker.inherit(old)
+            trackers.append(tracker)
+        self.face_trackers = trackers
+        return faces
+
+
+    def _trackFaces(self, small):
+        """Updates the face trackers and adds the tracked faces to the overlay metadata.
+            :param small: the mirrored frame the trackers were started on, at the same resolution
+            :returns: an n x 4 int32 array of face regions in full resolution frame
+                        coordinates, or None if any tracker lost its face
+        """
+        h, w = self.frame_dimensions
+        scale = w / small.shape[1]
+        faces = []
+        with timeStage(self.stage_times, "face_tracking"):
+            for tracker in self.face_trackers:
+                quality, box = tracker.update(small)
+                if quality < self.face_track_quality:
+                    return None
+                startX, startY, endX, endY = [int(c * scale) for c in box]
+                startX, startY = max(startX, 0), max(startY, 0)
+                endX, endY = min(endX, w), min(endY, h)
+                if endX - startX <= 0 or endY - startY <= 0:
+                    return None
+                faces.append((startX, startY, endX, endY))
+
+        self.overlay["faces"].extend(list(face) + [""] for face in faces)
+        return np.array(faces, np.int32).reshape(-1, 4)
+
+
+    def _register(self, frame, gray, username, faces=None):
         """Detects faces in frames and uses them to train a face recognition algorithm.
             Face data is associated with the given username.
-            :param frame: an 8 bit, 3-channel UMat object
-            :param gray: an 8-bit, 1-channel ndarray
+            :param frame: an 8 bit, 3-channel image in the backend's memory
+            :param gray: an 8-bit, 1-channel image in the backend's memory
             :param username: name of registering user
+            :param faces: face regions already found by _findFaces, if any
         """ 
         if self.samples < self.sample_size:
             
             # Find all faces and store only the location of the largest (closest to the camera)
-            faces = self._findFaces(frame)
+            if faces is None:
+                faces = self._findFaces(frame)
+            if self.annotate:
+                self._drawFaces(frame, faces)
             max_area = 0
             x = 0
             y = 0
@@ -115,32 +501,21 @@ class Recognition:
                     maxArea = w*h
                     
             # Resize and add face image to list for training
-            if faces:
+            if len(faces):
                 self.samples += 1
-                gray = cv2.UMat(gray,[y,y+h],[x,x+w])
-                gray = cv2.resize(gray, (100, 100))
-                self.sample_images.append(gray)
+                face = cv2.resize(self.backend.roi(gray, x, y, x+w, y+h), (100, 100))
+                self.sample_selector.add(toHost(face))
                     
         else:
             # Finished collecting face data
             # Associate registering user id with training data
             db = DBHelper()
             user_id = db.getIDByUsername(username)
-            id_array = [user_id] * self.sample_size
-
-            for i in range(self.sample_size):
-                self.sample_images[i] = cv2.UMat.get(self.sample_images[i])
 
-        # Update or create new face recognizer
-            if Path('./training_data/recognizer.yml').is_file():
-                self.recognizer.update(self.sample_images, np.array(id_array))
-            else:
-                self.recognizer.train(self.sample_images, np.array(id_array))
-            self.recognizer.write('./training_data/recognizer.yml')
-            
-            # registration complete
-            self.reg_complete = True
-            self.rec_trained = True
+            # Save the samples and train a new face recognizer in the background,
+            # registration completes when it is swapped in
+            self.training = self.trainer.submit(self._train, user_id,
+                                                self.sample_selector.images)
             
             # reset variables before detection begins
             self._reset()
@@ -148,11 +523,12 @@ class Recognition:
         return frame
 
 
-    def _detect(self, frame, gray):
+    def _detect(self, frame, gray, faces=None):
         """Detects faces, compares them registered faces, and detects hands for gesture
             recognition if a match is found.
-            :param frame: a BGR color image for display
-            :param gray: a grayscale copy of the passed BGR frame
+            :param frame: a BGR color image for display, in the backend's memory
+            :param gray: a grayscale copy of the passed BGR frame, in the backend's memory
+            :param faces: face regions already found by _findFaces, if any
             :returns: (out_frame, username, gesture) the processed frame
                 for display on webpage, the detected user, the detected gesture
         """
@@ -161,45 +537,65 @@ class Recognition:
         num_fingers = 0
         
         if self.gesture_tracker is None: # not currently tracking hands
-            faces = self._findFaces(frame)
+            recognized = []
+            if faces is None:
+                faces = self._findFaces(frame)
+            if self.annotate:
+                self._drawFaces(frame, faces)
+
+            # face trackers line up with faces while faces are being tracked
+            trackers = self.face_trackers
+            if len(trackers) != len(faces):
+                trackers = [None] * len(faces)
             
-            for (startX,startY,endX,endY) in faces:
+            for i, (startX,startY,endX,endY) in enumerate(faces):
                 # text is displayed at y coordinate
                 y = startY - 10 if startY - 10 > 10 else startY + 10
-                
-                # gray_face sometimes gets converted back to ndarray, throwing an error
-                # I do not know why
-                try:
-                    gray_face = cv2.UMat(gray,[startY,endY],[startX,endX])
-                except:
-                    gray_face = gray[startY:endY,startX:endX]
-
-                # optional resize for slightly improved performance 
-                gray_face = cv2.resize(gray_face, (100, 100))
-                user_id, confidence = self.recognizer.predict(gray_face)
-                gray = cv2.UMat.get(gray)
+
+                tracker = trackers[i]
+                cached = None
+                if tracker is not None:
+                    cached = tracker.cachedIdentity(self.identity_verify_interval,
+                                                    self.recognizer_version)
+                if cached is not None:
+                    user_id, confidence = cached
+                else:
+                    gray_face = self.backend.roi(gray, startX, startY, endX, endY)
+
+                    # optional resize for slightly improved performance 
+                    gray_face = toHost(cv2.resize(gray_face, (100, 100),
+                                                  self.buffers.get("face", (100, 100))))
+                    with timeStage(self.stage_times, "recognize"):
+                        user_id, confidence = self.recognizer.predict(gray_face)
+                    if tracker is not None:
+                        confidence = tracker.identify(user_id, confidence, self.recognizer_version)
 
                 # mask detected face region with solid black to avoid false positives in hand detection
-                gray[startY:endY,startX:endX] = self.black_mask[startY:endY,startX:endX]
-
-                # for LBPH recognizer, lower confidence scores indicate better results
-                if confidence <= 80: # user is recognized
-                    db = DBHelper()
-                    username = db.getUsernameById(user_id)
-                    cv2.putText(frame, username,
-                                (startX, y),
-                                self.font, .6,
-                                (225,105,65), 2)
+                cv2.rectangle(gray, (int(startX), int(startY)), (int(endX) - 1, int(endY) - 1), 0, cv2.FILLED)
+
+                # for both recognizers, lower confidence scores indicate better results
+                if confidence <= self.recognizer_threshold: # user is recognized
+                    username = self._lookupUsername(user_id)
+                    recognized.append((startX, startY, endX, endY))
+                    self.overlay["faces"][i][4] = username
+                    if self.annotate:
+                        cv2.putText(frame, username,
+                                    (startX, y),
+                                    self.font, .6,
+                                    (225,105,65), 2)
                 else:
                     # face belongs to unknown user
-                    cv2.putText(frame, "unknown",
-                                (startX, y),
-                                self.font, .6,
-                                (0, 0, 255), 2)
+                    self.overlay["faces"][i][4] = "unknown"
+                    if self.annotate:
+                        cv2.putText(frame, "unknown",
+                                    (startX, y),
+                                    self.font, .6,
+                                    (0, 0, 255), 2)
 
             # a user is recognized and hand detection begins
-            if username is not "" and faces:
-                hands = self.hand_classifier.detectMultiScale(gray, 1.3, 5)
+            if username != "" and len(faces):
+                with timeStage(self.stage_times, "hands"):
+                    hands = [hand for face in recognized for hand in self._findHands(gray, face)]
 
                 # detected hand region is resized to allow for tracking an open hand
                 for (x,y,w,h) in hands:
@@ -208,26 +604,42 @@ class Recognition:
                     x = int(x-x_mid*1.5)
                     w = int(w+3*x_mid)
                     h = int(h*2+h*0.7)
-                    cv2.rectangle(frame,(x,y),(x+w,y+h),(0, 0, 255), 2)
+                    self.overlay["hand"] = [x, y, w, h]
+                    if self.annotate:
+                        cv2.rectangle(frame,(x,y),(x+w,y+h),(0, 0, 255), 2)
 
                     # only attempt to recognize hand gesture if background model is finished calibrating
                     if self.bg_model.calibrated:
-                        self.gesture_tracker = GestureTracker(frame,(x,y,w,h))
+                        self.gesture_tracker = GestureTracker(toHost(frame),(x,y,w,h))
+
+                        # faces move while the hand is tracked, detect them again afterwards
+                        self.face_trackers = []
 
             # if no faces are in the frame, assume the frame is background
-            if not self.bg_model.calibrated and not faces:
-                self.bg_model.runAverage(frame)
+            if not self.bg_model.calibrated and not len(faces):
+                with timeStage(self.stage_times, "background"):
+                    self.bg_model.runAverage(gray)
 
         else: # hand has been detected and is being tracked by gesture_tracker
-            timed_out, (x,y,w,h) = self.gesture_tracker.update(frame)
+            # dlib tracks on host memory and the hand segment is pasted into the frame
+            frame = toHost(frame)
+            with timeStage(self.stage_times, "tracker"):
+                timed_out, (x,y,w,h) = self.gesture_tracker.update(frame, self.annotate)
+            self.overlay["hand"] = [x, y, w, h]
             if timed_out:
                 self.gesture_tracker = None
             try:
-                gray = cv2.UMat.get(gray)
-                difference = cv2.absdiff(self.bg_model.background.astype("uint8")[y:y+h,x:x+w],
-                                         gray[y:y+h,x:x+w])
-                foreground = cv2.threshold(difference, 25, 255, cv2.THRESH_BINARY)[1]
-                gest, frame[y:y+h,x:x+w] = self.gesture_recognizer.recognize(foreground)
+                # only the part of the hand region inside the frame is compared
+                frame_h, frame_w = self.frame_dimensions
+                x1, y1, x2, y2 = max(x, 0), max(y, 0), min(x+w, frame_w), min(y+h, frame_h)
+                with timeStage(self.stage_times, "background"):
+                    foreground = self.bg_model.foreground(gray, x1, y1, x2, y2)
+                    # lighting changes are followed everywhere but in the hand region
+                    self.bg_model.adapt(gray, (x1, y1, x2 - x1, y2 - y1))
+                with timeStage(self.stage_times, "gesture"):
+                    gest, segment = self.gesture_recognizer.recognize(foreground, self.annotate)
+                if self.annotate:
+                    frame[y1:y2,x1:x2] = segment
                 self.last_gest = str(gest)
             except:
                 pass
@@ -236,33 +648,93 @@ class Recognition:
         return (frame, username, gesture)
     
 
-    def _findFaces(self, frame):
-        """Forwards frame to a convolutional neural network for face detection. Draws rectangles
-            around detected faces.
-            :param frame: 8-bit, 3-channel ndarray
-            :returns: (face_regions) a list of rectangle points designating face locations
-        """
-        # input image can be resized up to 300x300 for improved accuracy
-        # or down to 100x100 for faster performance and worse accuracy
-        blob = cv2.dnn.blobFromImage(cv2.resize(frame, (150, 150)), 1.0,
-                                     (150, 150), (104.0, 177.0, 123.0))
-        self.facenet.setInput(blob)
-        detected_faces = self.facenet.forward()
+    def _findHands(self, gray, face):
+        """Searches for hands in the bands on either side of a recognized face
+            :param gray: an 8-bit, 1-channel image in the backend's memory
+            :param face: (startX, startY, endX, endY) of the face
+            :returns: list of (x, y, w, h) hand regions in frame coordinates
+        """
+        startX, startY, endX, endY = (int(v) for v in face)
+        face_w = endX - startX
+        face_h = endY - startY
+        frame_h, frame_w = self.frame_dimensions
+
+        # the cascade cannot find anything smaller than its 24x24 window
+        min_size = max(int(face_w * self.hand_size_range[0]), 24)
+        max_size = max(int(face_w * self.hand_size_range[1]), min_size)
+        width = int(face_w * self.hand_search_width)
+        top = max(startY - int(face_h * self.hand_search_above), 0)
+        bottom = min(endY + int(face_h * self.hand_search_below), frame_h)
+
+        hands = []
+        for left, right in ((max(startX - width, 0), startX), (endX, min(endX + width, frame_w))):
+            if right - left < min_size or bottom - top < min_size:
+                continue
+            band = self.backend.roi(gray, left, top, right, bottom)
+            for (x, y, w, h) in self.hand_classifier.detectMultiScale(band, 1.3, 5,
+                                                                      minSize=(min_size, min_size),
+                                                                      maxSize=(max_size, max_size)):
+                hands.append((x + left, y + top, w, h))
+        return hands
+
+    def _findFaces(self, frame, detected_faces=None):
+        """Forwards frame to a convolutional neural network for face detection and adds
+            detected faces to the overlay metadata.
+            :param frame: 8-bit, 3-channel ndarray, at full or reduced resolution
+            :param detected_faces: network output for frame from detectFaces, if the network
+                                    was already run on it as part of a batch
+            :returns: (face_regions) an n x 4 int32 array of (startX, startY, endX, endY)
+                        face locations in full resolution frame coordinates
+        """
+        if detected_faces is None:
+            with timeStage(self.stage_times, "detect"):
+                size = (self.face_input_size, self.face_input_size)
+                self.facenet.setInput(self._faceBlob(toHost(frame), size))
+                detected_faces = self.facenet.forward()
         h,w = self.frame_dimensions
-        face_regions = []
-
-        for i in range(0, detected_faces.shape[2]):
-            confidence = detected_faces[0,0,i,2]
-            if confidence > .4:
-                box = detected_faces[0,0,i,3:7] * np.array([w,h,w,h])
-                (startX, startY, endX, endY) = box.astype("int")
-                if (startX >= 0 and startY >= 0 and
-                    endX <= w and endY <= h):
-                    face_regions.append((startX, startY, endX, endY))
-                    cv2.rectangle(frame, (startX, startY), (endX, endY),
-                                  (225,105,65), 2)
 
+        # each detection is (image id, class id, confidence, startX, startY, endX, endY)
+        # with the coordinates relative to the frame size
+        detected_faces = detected_faces.reshape(-1, 7)
+        detected_faces = detected_faces[detected_faces[:,2] > self.face_confidence]
+        face_regions = (detected_faces[:,3:7] * np.array([w,h,w,h], np.float32)).astype(np.int32)
+        inside = ((face_regions[:,0] >= 0) & (face_regions[:,1] >= 0) &
+                  (face_regions[:,2] <= w) & (face_regions[:,3] <= h))
+        face_regions = face_regions[inside]
+
+        if self.face_nms_threshold is not None and len(face_regions) > 1:
+            rects = np.column_stack((face_regions[:,:2], face_regions[:,2:] - face_regions[:,:2]))
+            keep = cv2.dnn.NMSBoxes(rects.tolist(), detected_faces[inside,2].tolist(),
+                                    self.face_confidence, self.face_nms_threshold)
+            face_regions = face_regions[np.sort(np.asarray(keep, np.int32).reshape(-1))]
+
+        self.overlay["faces"].extend(face + [""] for face in face_regions.tolist())
         return face_regions
+
+
+    def _faceBlob(self, frame, size):
+        """Builds the face network input in preallocated buffers, equivalent to
+            cv2.dnn.blobFromImage(cv2.resize(frame, size), 1.0, size, (104.0, 177.0, 123.0))
+            :param frame: 8-bit, 3-channel ndarray
+            :param size: (width, height) of the network input
+            :returns: a 1 x 3 x height x width float32 blob
+        """
+        w, h = size
+        resized = cv2.resize(frame, size, self.buffers.get("net_input", (h, w, 3), host=True))
+        blob = self.buffers.get("blob", (1, 3, h, w), np.float32, host=True)
+        np.subtract(resized.transpose(2, 0, 1), self.face_mean, out=blob[0], casting="unsafe")
+        return blob
+
+
+    def _drawFaces(self, frame, faces):
+        """Draws rectangles around detected faces
+            :param frame: the displayed color frame
+            :param faces: face regions returned by _findFaces or _trackFaces
+            :side effect: input frame is modified
+        """
+        for (startX, startY, endX, endY) in faces:
+            cv2.rectangle(frame, (startX, startY), (endX, endY),
+                          (225,105,65), 2)
     
 
     def _displayProgress(self, frame):
@@ -288,12 +760,23 @@ class Recognition:
                     self.font, 1.2,(225,105,65), 2)
 
 
+    def _finishTraining(self):
+        """Completes the registration once the recognizer trained on it is swapped in
+        """
+        training, self.training = self.training, None
+        try:
+            training.result()
+        except Exception as e:
+            print("Could not train the face recognizer: {}".format(e))
+            return
+        self.reg_complete = True
+
     def _reset(self):
         """reinitializes variables used in gesture detection state
         """
         self.is_registering = False
         self.samples = 0
-        self.sample_images = []
+        self.sample_selector = SampleSelector(self.sample_budget)
 
 class GestureTracker:
     """Hand tracking class
@@ -310,7 +793,7 @@ class GestureTracker:
                                                             x+w,
                                                             y+h))
 
-    def update(self, frame):
+    def update(self, frame, annotate=True):
         
         tracking_quality = self.corr_tracker.update(frame)
         
@@ -322,42 +805,298 @@ class GestureTracker:
         y = int(tracked_position.top())
         w = int(tracked_position.width())
         h = int(tracked_position.height())
-        cv2.rectangle(frame, (x, y),
-                      (x + w, y + h),
-                      (0,255,0), 2)
+        if annotate:
+            cv2.rectangle(frame, (x, y),
+                          (x + w, y + h),
+                          (0,255,0), 2)
             
         return (self.timed_out, (x,y,w,h))
 
 
+class FaceTracker:
+    """Face tracking class
+        Follows a detected face between runs of the face detection network and
+        caches the identity the recognizer predicted for it, together with the
+        confidence scores of recent predictions.
+    """
+    # number of recent confidence scores averaged for the cached identity
+    history_size = 10
+
+    def __init__(self, frame, box):
+        startX, startY, endX, endY = box
+        self.box = tuple(box)
+        self.corr_tracker = dlib.correlation_tracker()
+        self.corr_tracker.start_track(frame, dlib.rectangle(startX, startY,
+                                                            endX, endY))
+
+        # identity cache
+        self.user_id = None
+        self.confidences = deque(maxlen=self.history_size)
+        self.frames_since_verify = 0
+        self.recognizer_version = None
+
+    def update(self, frame):
+        """:returns: (tracking_quality, (startX, startY, endX, endY))
+        """
+        tracking_quality = self.corr_tracker.update(frame)
+        tracked_position = self.corr_tracker.get_position()
+        self.box = (int(tracked_position.left()),
+                    int(tracked_position.top()),
+                    int(tracked_position.right()),
+                    int(tracked_position.bottom()))
+        return (tracking_quality, self.box)
+
+    def identify(self, user_id, confidence, recognizer_version):
+        """Records a recognizer prediction for the tracked face
+            :returns: the average confidence of recent predictions of this user
+        """
+        if user_id != self.user_id:
+            self.confidences.clear()
+        self.user_id = user_id
+        self.confidences.append(confidence)
+        self.frames_since_verify = 0
+        self.recognizer_version = recognizer_version
+        return sum(self.confidences) / len(self.confidences)
+
+    def cachedIdentity(self, verify_interval, recognizer_version):
+        """:returns: (user_id, confidence) of the cached identity, or None if the face
+                        has to be checked with the recognizer again
+        """
+        if (self.recognizer_version != recognizer_version or
+            self.frames_since_verify >= verify_interval):
+            return None
+        self.frames_since_verify += 1
+        return (self.user_id, sum(self.confidences) / len(self.confidences))
+
+    def inherit(self, other):
+        """Takes over the cached identity of a tracker that followed the same face"""
+        self.user_id = other.user_id
+        self.confidences = other.confidences
+        self.frames_since_verify = other.frames_since_verify
+        self.recognizer_version = other.recognizer_version
+
+
+class LatencyBudget:
+    """Latency budget controller
+        Keeps the time a camera's frames take near a target by trading face detection
+        accuracy for speed. Settings run from the most accurate, a large network input
+        on every frame, to the fastest, a small input every few frames with the face
+        trackers filling in. The controller moves one setting at a time, and waits
+        settle_frames after a move so that it sees the effect before moving again.
+    """
+    # (face_input_size, face_detect_interval) from most accurate to fastest
+    settings = [(300, 1), (300, 2), (200, 2), (200, 3), (150, 3), (150, 5),
+                (150, 8), (100, 8), (100, 12)]
+
+    # frames are over or under the budget when the average is outside target * (1 ± margin)
+    margin = 0.15
+    settle_frames = 15
+    smoothing = 0.1
+
+    def __init__(self, target, input_size=150, detect_interval=5):
+        """
+            :param target: milliseconds per frame
+            :param input_size: starting face_input_size
+            :param detect_interval: starting face_detect_interval
+        """
+        self.target = target
+        # start at the setting closest to the current one
+        self.index = min(range(len(self.settings)),
+                         key=lambda i: (abs(self.settings[i][0] - input_size),
+                                        abs(self.settings[i][1] - detect_interval)))
+        self.average = None
+        self.frames_since_change = 0
+
+    def setting(self):
+        """:returns: (face_input_size, face_detect_interval) to use"""
+        return self.settings[self.index]
+
+    def update(self, frame_ms):
+        """Adds the time of a frame to the running average
+            :returns: True if the setting changed
+        """
+        if self.average is None:
+            self.average = frame_ms
+        else:
+            self.average += self.smoothing * (frame_ms - self.average)
+        self.frames_since_change += 1
+        if self.frames_since_change < self.settle_frames:
+            return False
+
+        if self.average > self.target * (1 + self.margin) and self.index < len(self.settings) - 1:
+            self.index += 1
+        elif self.average < self.target * (1 - self.margin) and self.index > 0:
+            self.index -= 1
+        else:
+            return False
+        self.frames_since_change = 0
+        return True
+
+
+class SampleSelector:
+    """Registration sample selector
+        Keeps the most diverse face samples of a registration, compared by the cosine
+        distance of their LBP features. Samples are kept until the budget is reached.
+        After that a new sample replaces the kept sample that is closest to another
+        one, if the new sample is further than that from every other kept sample, so
+        near duplicates of consecutive frames give way to new poses and lighting.
+    """
+    def __init__(self, budget):
+        """
+            :param budget: maximum number of samples kept
+        """
+        self.budget = budget
+        self.images = []
+        self.features = None
+        # distances between the kept samples, infinite on the diagonal
+        self.distances = np.full((budget, budget), np.inf, np.float32)
+
+    def add(self, image):
+        """Offers a sample
+            :param image: 8-bit grayscale face image
+            :returns: True if the sample was kept
+        """
+        features = lbpFeatures(image)
+        if self.features is None:
+            self.features = np.empty((self.budget, len(features)), np.float32)
+        n = len(self.images)
+        distances = 1 - self.features[:n] @ features
+
+        if n < self.budget:
+            i = n
+            self.images.append(image)
+        else:
+            nearest = self.distances.min(axis=1)
+            i = int(np.argmin(nearest))
+            others = np.delete(distances, i)
+            if not len(others) or others.min() <= nearest[i]:
+                return False
+            self.images[i] = image
+        self.features[i] = features
+        self.distances[i, :n] = distances
+        self.distances[:n, i] = distances
+        self.distances[i, i] = np.inf
+        return True
+
+
 class BackgroundModel:
     """Frame background model class
         This class uses openCV image processing algorithms to generate an average
-        value model from the backgrounds of a series of 30 frames. It assumes that
-        the camera sending frames will remain stationary, as it does no modification
-        to the model after calibration is complete
+        value model from the backgrounds of a series of calibration frames. It assumes
+        that the camera sending frames will remain stationary. After calibration the
+        model can keep adapting to lighting changes, blending one stripe of rows of a
+        frame into it per call to adapt so that no frame pays for a full update. An
+        8-bit copy of the model for comparing frames with is kept up to date with it.
     """
-    def __init__(self):
-        
+    def __init__(self, backend, calibration_frames=30, adapt_rate=0.0, stripes=8, blur=(9, 9)):
+        """
+            :param backend: the backend.Backend the frames are in
+            :param calibration_frames: number of frames averaged before the model is used
+            :param adapt_rate: weight of a frame's pixels when adapting, 0 to never adapt
+            :param stripes: number of calls to adapt it takes to update every row once
+            :param blur: size of the Gaussian blur applied to frames, None for no blur
+        """
+        self.backend = backend
+        self.buffers = BufferPool(backend)
+        self.calibration_frames = calibration_frames
+        self.adapt_rate = adapt_rate
+        self.stripes = stripes
+        self.blur = blur
+
         self.calibrated = False
         self.background = None
+        # 8-bit copy of background, refreshed whenever background changes
+        self.image = None
+        self.shape = None
         self.num_frames = 0
+        self.stripe = 0
 
-    def runAverage(self, frame):
+    def runAverage(self, gray):
         """Calculates weighted average of background pixel values in given frames.
-            :param frame: 3-channel color image
+            :param gray: equalized 8-bit, 1-channel frame, an ndarray or UMat
             :side effect: background attribute is updated with information from new frames
-            :side effect: calibrated attribute is switched to true after processing 30 frames
-        """
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        gray = cv2.equalizeHist(gray)
-        gray = cv2.GaussianBlur(gray, (9, 9), 0)
-        if self.num_frames < 30:
-            if self.background is None:
-                self.background = gray.copy().astype("float")
-            cv2.accumulateWeighted(gray, self.background, 0.5)
-            self.num_frames += 1
-        else:
+            :side effect: calibrated attribute is switched to true after calibration_frames frames
+        """
+        if self.blur is not None:
+            gray = cv2.GaussianBlur(gray, self.blur, 0)
+        if self.background is None:
+            self.shape = toHost(gray).shape
+            self.background = cv2.multiply(gray, 1.0, dtype=cv2.CV_32F)
+        cv2.accumulateWeighted(gray, self.background, 0.5)
+        self.num_frames += 1
+        if self.num_frames >= self.calibration_frames:
             self.calibrated = True
+            self.image = cv2.convertScaleAbs(self.background)
+
+    def foreground(self, gray, startX, startY, endX, endY, threshold=25):
+        """Compares a region of a frame with the calibrated background
+            :param gray: equalized 8-bit, 1-channel frame, an ndarray or UMat
+            :param threshold: smallest difference from the background that is foreground
+            :returns: 8-bit mask of the region, 255 where the frame differs from the
+                        background. Its memory is reused by the next call
+        """
+        region = (endY - startY, endX - startX)
+        difference = cv2.absdiff(self.backend.roi(self.image, startX, startY, endX, endY),
+                                 self.backend.roi(gray, startX, startY, endX, endY),
+                                 self.buffers.get("difference", region))
+        return cv2.threshold(difference, threshold, 255, cv2.THRESH_BINARY,
+                             self.buffers.get("foreground", region))[1]
+
+    def adapt(self, gray, exclude=None):
+        """Blends the next stripe of rows of a frame into the calibrated background
+            :param gray: equalized 8-bit, 1-channel frame, an ndarray or UMat
+            :param exclude: (x, y, w, h) region whose pixels are left out, such as a tracked hand
+        """
+        if not self.calibrated or self.adapt_rate <= 0:
+            return
+        h, w = self.shape
+        top = h * self.stripe // self.stripes
+        bottom = h * (self.stripe + 1) // self.stripes
+        self.stripe = (self.stripe + 1) % self.stripes
+
+        stripe = self.backend.roi(gray, 0, top, w, bottom)
+        if self.blur is not None:
+            stripe = cv2.GaussianBlur(stripe, self.blur, 0,
+                                      self.buffers.get("blurred", (bottom - top, w)))
+        mask = None
+        if exclude is not None:
+            x, y, ex_w, ex_h = exclude
+            mask = self.buffers.get("mask", (bottom - top, w))
+            cv2.rectangle(mask, (0, 0), (w - 1, bottom - top - 1), 255, cv2.FILLED)
+            if ex_w > 0 and ex_h > 0 and y < bottom and y + ex_h > top:
+                cv2.rectangle(mask, (int(x), int(y - top)), (int(x + ex_w - 1), int(y + ex_h - 1 - top)),
+                              0, cv2.FILLED)
+
+        background = self.backend.roi(self.background, 0, top, w, bottom)
+        cv2.accumulateWeighted(stripe, background, self.adapt_rate, mask)
+        cv2.convertScaleAbs(background, self.backend.roi(self.image, 0, top, w, bottom))
+
+
+def _warmUpFacenet(net):
+    size = Recognition.face_input_size
+    net.setInput(np.zeros((1, 3, size, size), np.float32))
+    net.forward()
+
+models.register("facenet", lambda: cv2.dnn.readNetFromCaffe(Recognition.path_faceproto,
+                                                            Recognition.path_facemodel),
+                _warmUpFacenet)
+models.register("hand_classifier", lambda: cv2.CascadeClassifier(Recognition.path_handmodel),
+                lambda classifier: classifier.detectMultiScale(np.zeros((120, 160), np.uint8), 1.3, 5))
+models.register("gesture_recognizer", HandGestureRecognition,
+                lambda recognizer: recognizer.recognize(np.zeros((100, 100), np.uint8)))
+
+
+def intersectionOverUnion(a, b):
+    """Overlap of two (startX, startY, endX, endY) rectangles
+        :returns: area of intersection / area of union, between 0 and 1
+    """
+    w = min(a[2], b[2]) - max(a[0], b[0])
+    h = min(a[3], b[3]) - max(a[1], b[1])
+    if w <= 0 or h <= 0:
+        return 0.0
+    intersection = w * h
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection
+    return intersection / union
 
 
 if __name__ == "__main__":
@@ -0,0 +1,94 @@
+"""
+Project: FandRec
+Description: Recording and reading of camera frame streams, used to reproduce
+             problems without a camera attached.
+Notes:
+    1. A recording starts with an 8 byte file header followed by one record per
+       frame. Each record is
+           length     4 bytes  unsigned, size of the message
+           timestamp  8 bytes  time the message was recorded, seconds since the epoch
+           message    length bytes, a binary frame message (see frame_protocol)
+       in network byte order.
+    2. Recordings are append only. A record cut short by a crash is ignored when
+       the recording is read back.
+    3. FrameReader memory maps the recording, so reading a multi-GB capture
+       does not load it into memory.
+"""
+import mmap, os, struct, time
+
+FILE_HEADER = b"FRREC\0\0\1"
+RECORD = struct.Struct("!Id")
+
+
+class FrameRecorder:
+    """Appends frame messages to a recording file"""
+
+    def __init__(self, path):
+        """
+            :param path: recording file, created if it does not exist
+        """
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, "ab")
+        if new_file:
+            self.file.write(FILE_HEADER)
+        else:
+            with open(path, "rb") as existing:
+                if existing.read(len(FILE_HEADER)) != FILE_HEADER:
+                    self.file.close()
+                    raise ValueError("{} is not a frame recording".format(path))
+        self.frames = 0
+
+    def write(self, message, timestamp=None):
+        """Appends one frame message
+            :param message: bytes of a binary frame message
+            :param timestamp: time the message was received, defaults to now
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        self.file.write(RECORD.pack(len(message), timestamp))
+        self.file.write(message)
+        self.frames += 1
+
+    def close(self):
+        self.file.close()
+
+
+class FrameReader:
+    """Reads a recording through a read-only memory map
+        Iterating yields (timestamp, message) pairs where message is a memoryview
+        into the map. Views must be released before the reader is closed.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(FILE_HEADER)] != FILE_HEADER:
+            self.close()
+            raise ValueError("{} is not a frame recording".format(path))
+
+    def __iter__(self):
+        view = memoryview(self.map)
+        offset = len(FILE_HEADER)
+        end = len(self.map)
+        try:
+            while offset + RECORD.size <= end:
+                length, timestamp = RECORD.unpack_from(self.map, offset)
+                offset += RECORD.size
+                if offset + length > end: # truncated record
+                    break
+                message = view[offset:offset + length]
+                yield (timestamp, message)
+                message.release()
+                offset += length
+        finally:
+            view.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.map.close()
+        self.file.close()
@@ -0,0 +1,115 @@
+"""
+Project: FandRec
+Description: Replays a frame recording made by the camera server or camera_client
+             into the camera server, in place of a live camera.
+Notes:
+    1. Usage: python replay_client.py <recording> [--rate original|fast|<fps>] [--loop]
+           original  --  frames are sent with the gaps they were recorded with
+           fast      --  frames are sent as fast as the connection allows
+           <fps>     --  frames are sent at a fixed number of frames per second
+    2. The recording is memory mapped and read one frame at a time.
+"""
+#==============================Imports=======================================
+import sys, argparse, time
+
+from twisted.python import log
+from twisted.internet import reactor
+
+from autobahn.twisted.websocket import WebSocketClientFactory, \
+    WebSocketClientProtocol
+
+from frame_protocol import unpackFrame
+from recorder import FrameReader
+#=======================Application Interface===========================
+class ReplayClientProtocol(WebSocketClientProtocol):
+    """
+    Description: Sends the frames of a recording to the server at the requested rate.
+    """
+
+    def onOpen(self):
+        self.frames = iter(self.factory.reader)
+        self.start_time = time.time()
+        self.first_timestamp = None
+        self.sent = 0
+        self.sendFrames()
+
+    def sendFrames(self):
+        """
+        Description: Reads the next frame and sends it once it is due.
+        """
+        try:
+            timestamp, message = next(self.frames)
+        except StopIteration:
+            if self.factory.loop:
+                self.onOpen()
+            else:
+                print("Replayed {} frames in {:.1f}s".format(self.sent, time.time() - self.start_time))
+                self.sendClose()
+            return
+
+        if self.first_timestamp is None:
+            self.first_timestamp = timestamp
+
+        if self.factory.rate == "fast":
+            delay = 0
+        elif self.factory.rate == "original":
+            due = self.start_time + (timestamp - self.first_timestamp)
+            delay = max(0, due - time.time())
+        else:
+            delay = 1/self.factory.rate if self.sent else 0
+        reactor.callLater(delay, self.sendRecordedFrame, message)
+
+    def sendRecordedFrame(self, message):
+        self.sendMessage(bytes(message), isBinary=True)
+        message.release()
+        self.sent += 1
+        self.sendFrames()
+
+    def onClose(self, wasClean, code, reason):
+        reactor.stop()
+
+
+class ReplayClientFactory(WebSocketClientFactory):
+    """
+    Description: Opens the recording and connects as the camera it was recorded from.
+    """
+    def __init__(self, addr, reader, rate, loop):
+        camera_id = "camera1"
+        for timestamp, message in reader:
+            camera_id = unpackFrame(message).camera_id
+            message.release()
+            break
+        WebSocketClientFactory.__init__(self, addr, headers={'camera_id': camera_id})
+        self.reader = reader
+        self.rate = rate
+        self.loop = loop
+
+#=================Client Main===================================
+
+def main():
+    """
+    Description: Replays a recording into the camera server.
+    """
+    parser = argparse.ArgumentParser(description="Replay a frame recording into the camera server")
+    parser.add_argument("recording")
+    parser.add_argument("--rate", default="original",
+                        help="original, fast or a fixed number of frames per second")
+    parser.add_argument("--loop", action="store_true", help="start over at the end of the recording")
+    parser.add_argument("--address", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8091)
+    args = parser.parse_args()
+
+    rate = args.rate if args.rate in ("original", "fast") else float(args.rate)
+
+    #STEP 1: Setup the factory
+    log.startLogging(sys.stdout)
+    reader = FrameReader(args.recording)
+    factory = ReplayClientFactory("ws://" + args.address + ":" + str(args.port), reader, rate, args.loop)
+    factory.protocol = ReplayClientProtocol
+    reactor.connectTCP(args.address, args.port, factory)
+
+    #STEP 2: Start the reactor
+    reactor.run()
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,32 @@
 //=====================Global Vars==================================
 var webSocket = null;
 var image = null;
+var imageUrl = null;
 var acusArray;
 
+// with ?overlay=client the server sends untouched camera frames and the
+// face/hand/gesture overlay is drawn here instead
+var overlayMode = new URLSearchParams(window.location.search).get("overlay") == "client" ? "client" : "server";
+var overlay = null;
+var overlayCanvas = null;
+
 function applicationViewModel() {
 
     var address = "ws://127.0.0.1:8092/ws";
 
     webSocket = new WebSocket(address);
+    webSocket.binaryType = "blob";
     console.log("websocket started")
 
+    // a camera can be picked with ?camera=<camera_id>, otherwise the
+    // server sends the signed in user's camera
+    webSocket.onopen = function () {
+        var camera = new URLSearchParams(window.location.search).get("camera");
+        if (camera || overlayMode == "client") {
+            subscribe(camera);
+        }
+    }
+
     /*     webSocket.onopen = function () {
             if (window.location.pathname == "/index.html" ||
                 window.location.pathname == "/") {
@@ -25,7 +42,15 @@ function applicationViewModel() {
     }
 
     webSocket.onmessage = function (e) {
-        if (e.data.startsWith("cvoMessage")) {
+        if (e.data instanceof Blob) {
+            if (overlayMode == "client") {
+                drawOverlay(e.data);
+            } else {
+                draw(e.data);
+            }
+        } else if (e.data.startsWith("{")) {
+            overlay = JSON.parse(e.data);
+        } else if (e.data.startsWith("cvoMessage")) {
             console.log('nothing')
         } else if (e.data.startsWith("registration")) {
             console.log("message from registration service. ");
@@ -35,13 +60,15 @@ function applicationViewModel() {
         } else if (e.data.startsWith("autoAuth")) {
             var user = e.data.split('|')[1];
             window.location.href = '/reg_complete';
-        } else {
-            draw(e.data);
         }
     }
 
 }
 
+function subscribe(camera) {
+    webSocket.send(JSON.stringify({"subscribe": camera, "overlay": overlayMode}));
+}
+
 function sendCompesInfo() {
     var id = document.getElementById('POST');
     var masterString = "sendCompes";
@@ -62,13 +89,73 @@ function sendAssignInfo() {
 function draw(input) {
     try {
         let image = document.getElementsByClassName("frame-display")[0];
-        image.src = "data:image/jpg;base64," + input;        
+        if (imageUrl) {
+            URL.revokeObjectURL(imageUrl);
+        }
+        imageUrl = URL.createObjectURL(input);
+        image.src = imageUrl;
     }
     catch {
         //do nothing
     }
 }
 
+function drawOverlay(input) {
+    /*
+    Description: Draws a mirrored camera frame and the latest overlay metadata
+                 (face boxes, usernames, hand box, gesture or registration progress)
+                 onto a canvas shown in place of the frame image.
+    */
+    createImageBitmap(input).then(function (bitmap) {
+        if (overlayCanvas == null) {
+            let image = document.getElementsByClassName("frame-display")[0];
+            overlayCanvas = document.createElement("canvas");
+            overlayCanvas.className = image.className;
+            image.parentNode.replaceChild(overlayCanvas, image);
+        }
+        overlayCanvas.width = bitmap.width;
+        overlayCanvas.height = bitmap.height;
+
+        let ctx = overlayCanvas.getContext("2d");
+        ctx.save();
+        ctx.scale(-1, 1);
+        ctx.drawImage(bitmap, -bitmap.width, 0);
+        ctx.restore();
+        bitmap.close();
+
+        if (overlay == null || overlay.size == null) {
+            return;
+        }
+        ctx.scale(bitmap.width / overlay.size[0], bitmap.height / overlay.size[1]);
+        ctx.lineWidth = 2;
+
+        ctx.font = "16px sans-serif";
+        overlay.faces.forEach(function (face) {
+            let color = face[4] == "unknown" ? "rgb(255,0,0)" : "rgb(65,105,225)";
+            ctx.strokeStyle = "rgb(65,105,225)";
+            ctx.strokeRect(face[0], face[1], face[2] - face[0], face[3] - face[1]);
+            if (face[4]) {
+                ctx.fillStyle = color;
+                ctx.fillText(face[4], face[0], face[1] - 10 > 10 ? face[1] - 10 : face[1] + 10);
+            }
+        });
+
+        if (overlay.hand) {
+            ctx.strokeStyle = "rgb(0,255,0)";
+            ctx.strokeRect(overlay.hand[0], overlay.hand[1], overlay.hand[2], overlay.hand[3]);
+        }
+
+        ctx.font = "32px sans-serif";
+        if (overlay.progress != null) {
+            ctx.fillStyle = "rgb(0,255,0)";
+            ctx.fillText(overlay.progress + "%", 25, 30);
+        } else if (overlay.gesture != null) {
+            ctx.fillStyle = "rgb(65,105,225)";
+            ctx.fillText("Gesture:  " + overlay.gesture, 25, 30);
+        }
+    });
+}
+
 
 $(document).ready(function () {
     /*
@@ -0,0 +1,100 @@
+"""
+Project: FandRec
+Description: Checks that the stages writing into a BufferPool allocate nothing new
+             once their buffers exist.
+Notes:
+    1. Every stage is run once to allocate its buffers, then traced with tracemalloc
+       while it runs again on the same pool. The second pass must keep the same
+       buffers, leave no more blocks of at least 1 KiB allocated from the stage's
+       module than the first, and never hold a block the size of one of its
+       buffers at any time. Smaller blocks are the Python objects every call
+       creates and frees.
+    2. Stages in recognition are skipped when dlib is not installed.
+"""
+import tracemalloc
+
+import numpy as np
+import pytest
+
+from backend import BACKENDS, BufferPool
+
+
+def buffersOf(pool):
+    return {name: id(entry[1]) for name, entry in pool.buffers.items()}
+
+
+def secondPass(run, pool, module):
+    """Runs a stage twice and traces the second run
+        :param run: function running the stage once
+        :param pool: the BufferPool the stage writes into
+        :param module: file name of the stage's module, the allocations counted are
+                        the ones made from its lines
+        :returns: (new_blocks, peak), the number of blocks of at least 1 KiB allocated
+                    from module by the second run and still alive, and the peak bytes
+                    traced during it
+    """
+    run()
+    buffers = buffersOf(pool)
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        tracemalloc.clear_traces()
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    assert buffersOf(pool) == buffers, "buffers were reallocated"
+
+    only = [tracemalloc.Filter(True, "*" + module)]
+    def largeBlocks(snapshot):
+        return sum(1 for trace in snapshot.filter_traces(only).traces if trace.size >= 1024)
+    return (largeBlocks(after) - largeBlocks(before), peak)
+
+
+def smallestBuffer(pool):
+    return min(entry[1].nbytes for entry in pool.buffers.values())
+
+
+def handMask(h=120, w=160):
+    mask = np.zeros((h, w), np.uint8)
+    mask[h//2:, w//4:w*3//4] = 255
+    for i in range(4):
+        x = w//4 + 8 + i * w//9
+        mask[h//8:h//2, x:x + 8] = 255
+    return mask
+
+
+@pytest.mark.parametrize("annotate", [True, False])
+def test_gesture_recognize(annotate):
+    from gesture import HandGestureRecognition
+    recognizer = HandGestureRecognition()
+    mask = handMask()
+    new_blocks, peak = secondPass(lambda: recognizer.recognize(mask, annotate),
+                                  recognizer.buffers, "gesture.py")
+    assert new_blocks == 0
+    assert peak < smallestBuffer(recognizer.buffers)
+
+
+def test_background_adapt():
+    pytest.importorskip("dlib")
+    from recognition import BackgroundModel
+    model = BackgroundModel(BACKENDS["cpu"], calibration_frames=1, adapt_rate=0.05, stripes=1)
+    gray = np.random.default_rng(0).integers(0, 256, (480, 640), dtype=np.uint8)
+    model.runAverage(gray)
+    new_blocks, peak = secondPass(lambda: model.adapt(gray, (100, 100, 160, 200)),
+                                  model.buffers, "recognition.py")
+    assert new_blocks == 0
+    assert peak < smallestBuffer(model.buffers)
+
+
+def test_face_blob():
+    pytest.importorskip("dlib")
+    from recognition import Recognition
+    rec = Recognition.__new__(Recognition)
+    rec.buffers = BufferPool(BACKENDS["cpu"])
+    frame = np.random.default_rng(0).integers(0, 256, (240, 320, 3), dtype=np.uint8)
+    new_blocks, peak = secondPass(lambda: rec._faceBlob(frame, (150, 150)),
+                                  rec.buffers, "recognition.py")
+    assert new_blocks == 0
+    assert peak < smallestBuffer(rec.buffers)
@@ -0,0 +1,44 @@
+"""
+Project: FandRec
+Description: Checks that recordings are read back frame by frame and that readers
+             can stop before the end of a recording.
+"""
+import cv2, numpy as np
+
+from frame_protocol import packFrame, unpackFrame
+from recorder import FrameRecorder, FrameReader
+import benchmark
+
+
+def record(path, count):
+    recorder = FrameRecorder(path)
+    for i in range(count):
+        image = np.full((48, 64, 3), i * 10, np.uint8)
+        payload = cv2.imencode(".jpg", image)[1].tobytes()
+        recorder.write(packFrame("camera1", i, float(i), payload), timestamp=float(i))
+    recorder.close()
+
+
+def test_read_all(tmp_path):
+    path = str(tmp_path / "camera1.frrec")
+    record(path, 3)
+    with FrameReader(path) as reader:
+        sequences = []
+        for timestamp, message in reader:
+            sequences.append(unpackFrame(message).sequence)
+            message.release()
+    assert sequences == [0, 1, 2]
+
+
+def test_recorded_frames_fewer_than_recording(tmp_path):
+    path = str(tmp_path / "camera1.frrec")
+    record(path, 5)
+    frames = benchmark.recordedFrames(path, 2)
+    assert len(frames) == 2
+    assert frames[0].shape == (48, 64, 3)
+
+
+def test_recorded_frames_more_than_recording(tmp_path):
+    path = str(tmp_path / "camera1.frrec")
+    record(path, 3)
+    assert len(benchmark.recordedFrames(path, 30)) == 3